@@ -6,8 +6,15 @@
 #
 
 import pickle
+import multiprocessing as mp
 import numpy as np
 from sklearn.tree import DecisionTreeClassifier
+import flatForest
+import modelFile
+import sharedArray
+
+# Training data of the worker processes (set by _init_worker)
+_worker_data = {}
 
 class BalRandomForest:
     """
@@ -25,8 +32,8 @@ class BalRandomForest:
         self.tagged_legit = legit
         self.tagged_scams = scams
         self.test_sample  = np.array([[]])
-        self.train_sample = np.array([[]])
         self.estimators   = []
+        self.flat_forest  = None
         if len(legit)>0 and len(scams)>0:
             self._add_tags()
         self._train_size = train_size
@@ -35,7 +42,15 @@ class BalRandomForest:
         """
         Loads the already trained model
         """
-        self.estimators = model
+        self.estimators  = model
+        self.flat_forest = None
+
+    def compile_model(self):
+        """
+        Packs the trained estimators into flat node arrays
+        used for the prediction
+        """
+        self.flat_forest = flatForest.compile_estimators(self.estimators)
 
     def _add_tags(self):
         """
@@ -63,39 +78,91 @@ class BalRandomForest:
         rnd_idx = np.random.permutation(len(self.test_sample))
         self.test_sample = self.test_sample[rnd_idx, :] 
 
-    def _prep_bal_data(self):
+    def _prep_bal_data(self, rng=np.random):
         """
         This is an bootstraped balanced training set. It can 
-        be used for the resampling validation.
-        """
-        test_size = int((1.-self._train_size)*len(self.tagged_scams))
-        train_scams_size = len(self.tagged_scams)-test_size
-        train_legit_size = len(self.tagged_legit)-test_size
-        rem_scams = self.tagged_scams[:train_scams_size]
-        rem_legit = self.tagged_legit[:train_legit_size] 
-        # booststrap
-        boot_scams = rem_scams[np.random.permutation(len(rem_scams))]
-        boot_legit = rem_legit[np.random.permutation(len(rem_legit))]
-        rnd_idx = np.random.randint(train_scams_size, size=train_scams_size)
-        boot_legit = boot_legit[rnd_idx, :]
-        rnd_idx = np.random.randint(train_scams_size, size=train_scams_size)
-        boot_scams = boot_scams[rnd_idx, :]   
-        # join and randomize the sets
-        train_sample = np.concatenate((boot_scams, boot_legit), axis=0)
-        self.train_sample = train_sample[np.random.permutation(len(train_sample))]
-
-    def train(self, n_estimators=1000): 
-        """
-        Trains the balanced random forest
-
-        Input:  number of estimators (default 1000)
-        """
-        self.estimators = []
-        for n in range(n_estimators):
-            self._prep_bal_data()
-            clf = DecisionTreeClassifier(max_features="auto")
-            clf.fit(self.train_sample[:, :-1], self.train_sample[:, -1])
-            self.estimators.append(clf)
+        be used for the resampling validation. Only the row indices
+        are drawn: they point into the rows of the training matrix
+        (see _get_train_matrix).
+
+        Input:  random number generator (default numpy's global one)
+        Output: array of row indices
+        """
+        return _get_bal_idx(len(self.tagged_legit), len(self.tagged_scams),
+                            self._train_size, rng)
+
+    def _get_train_matrix(self, share=False):
+        """
+        Returns the features (float32, as used by the CARTs) and the
+        tags of the legit rows followed by the scams rows. They are
+        shared by all the trees.
+
+        Input:  whether to put the arrays in shared memory
+        Output: feature matrix, tag array
+        """
+        tagged = np.concatenate((self.tagged_legit, self.tagged_scams), axis=0)
+        if share:
+            return sharedArray.share_array(tagged[:, :-1], np.float32), \
+                   sharedArray.share_array(tagged[:, -1])
+        return np.ascontiguousarray(tagged[:, :-1], dtype=np.float32), tagged[:, -1]
+
+    def train(self, n_estimators=1000, n_jobs=1): 
+        """
+        Trains the balanced random forest. Each tree gets its own seed
+        (drawn from numpy's global generator), so the model only depends
+        on that generator and not on the number of workers.
+
+        Input:  number of estimators (default 1000),
+                number of worker processes (default 1, None for all cores)
+        """
+        self.estimators  = self._grow_estimators(n_estimators, n_jobs)
+        self.flat_forest = None
+
+    def update(self, legit, scams, n_estimators=100, max_estimators=1000, n_jobs=1):
+        """
+        Incremental (sliding window) training: grows new trees on the
+        latest labelled batch and retires the oldest trees, so that the
+        ensemble only reflects the most recent batches. The batch 
+        becomes the tagged data of the forest (e.g. for 
+        allocate_test_sample).
+
+        Input:  legit feature array, scams feature array (no class tags!),
+                number of new estimators (default 100), maximum number
+                of estimators kept (default 1000), number of worker processes
+        """
+        if len(self.estimators)==0 and self.flat_forest!=None:
+            raise ValueError("A model loaded from a model file cannot be updated")
+        self.tagged_legit = legit
+        self.tagged_scams = scams
+        self._add_tags()
+        new_estimators = self._grow_estimators(n_estimators, n_jobs)
+        # the estimators are kept from the oldest to the newest
+        self.estimators  = (list(self.estimators) + new_estimators)[-max_estimators:]
+        self.flat_forest = None
+
+    def _grow_estimators(self, n_estimators, n_jobs=1):
+        """
+        Returns n_estimators CARTs trained on the tagged data
+        """
+        seeds = np.random.randint(np.iinfo(np.int32).max, size=n_estimators)
+        n_legit = len(self.tagged_legit)
+        n_scams = len(self.tagged_scams)
+        if n_jobs==1:
+            x, x_tag = self._get_train_matrix()
+            return [_fit_bal_tree(x, x_tag, n_legit, n_scams, self._train_size, seed)
+                    for seed in seeds]
+        if n_jobs==None:
+            n_jobs = mp.cpu_count()
+        # the training data goes to the workers once, in shared memory
+        x, x_tag = self._get_train_matrix(share=True)
+        pool = mp.Pool(n_jobs, initializer=_init_worker,
+                       initargs=(x, x_tag, n_legit, n_scams, self._train_size))
+        try:
+            return pool.map(_fit_worker_tree, seeds, 
+                            chunksize=max(1, n_estimators/(4*n_jobs)))
+        finally:
+            pool.close()
+            pool.join()
 
     def predict(self, x):
         """
@@ -103,11 +170,23 @@ class BalRandomForest:
 
         Input:  feature array
         """
-        prediction = []
-        for clf in self.estimators:
-            prediction.append(clf.predict(x))
-        prediction = np.array(prediction)
-        return np.mean(prediction, axis=0)
+        if self.flat_forest==None:
+            self.compile_model()
+        return self.flat_forest.predict(x)
+
+    def predict_early_exit(self, x, thresholds, block_size=50, delta=0.01):
+        """
+        Returns the prediction (between 0 and 1) stopping early for the
+        rows whose side of the thresholds is known before all the trees
+        are evaluated (see FlatForest.predict_early_exit)
+
+        Input:  feature array, thresholds (e.g. of the labels), number
+                of trees per block, probability of a wrong side
+        Output: array of predictions, number of trees used per row
+        """
+        if self.flat_forest==None:
+            self.compile_model()
+        return self.flat_forest.predict_early_exit(x, thresholds, block_size, delta)
 
     def classify(self, x, threshold=0.5):
         """
@@ -131,18 +210,10 @@ class BalRandomForest:
 
         Input:  feature array, class array
         """
-        clsf = self.classify(x)
-        err_idx = (clsf!=x_tag)
-        err  = sum(err_idx)/(1.*len(err_idx))  
-        n_fpos = 0
-        n_fneg = 0
-        for t in range(len(x_tag)):
-            if x_tag[t] and not clsf[t]:
-                n_fneg += 1
-            elif not x_tag[t] and clsf[t]:
-                n_fpos += 1
-            else:
-                continue
+        conf_mat = self.get_confusion_matrix(x, x_tag)
+        n_fneg = conf_mat[0][1]
+        n_fpos = conf_mat[1][0]
+        err  = (n_fpos+n_fneg)/(len(x_tag)*1.)
         fpos = n_fpos/(len(x_tag)*1.)
         fneg = n_fneg/(len(x_tag)*1.)
         return err, fpos, fneg
@@ -151,17 +222,17 @@ class BalRandomForest:
         """
         Returns the confusion matrix
         """
-        clsf = self.classify(x, threshold)
-        # Correct predictions
-        true_idx = (clsf==x_tag)
-        true_positive = sum(x_tag[true_idx])
-        true_negative = sum((x_tag[true_idx]-1)*(-1))  # inverts the tags
-        # Wrong predictions 
-        false_idx = (clsf!=x_tag)
-        false_positive = sum((x_tag[false_idx]-1)*(-1)) # inverts the tags
-        false_negative = sum(x_tag[false_idx])
-        return np.array([[true_negative, false_negative],   #   tn  fn
-                         [false_positive, true_positive]])  #   fp  tp
+        return self.get_confusion_matrices(x, x_tag, [threshold])[0]
+
+    def get_confusion_matrices(self, x, x_tag, threshold_arr):
+        """
+        Returns the confusion matrices for all the thresholds.
+        The sample is only scored once.
+
+        Input:  feature array, class array, array of thresholds
+        Output: array of confusion matrices (n_thresholds x 2 x 2)
+        """
+        return get_score_confusion_matrices(self.predict(x), x_tag, threshold_arr)
 
     def get_precision_recall(self, conf_matrix):
         """
@@ -181,8 +252,7 @@ class BalRandomForest:
         Returns the recall vs precision curve
         """
         curve = []
-        for t in threshold_arr:
-            conf_mat = self.get_confusion_matrix(x, x_tag, t)
+        for conf_mat in self.get_confusion_matrices(x, x_tag, threshold_arr):
             precision, recall, fpos_rate = self.get_precision_recall(conf_mat)
             curve.append([recall, precision])
         return np.array(curve)
@@ -192,8 +262,9 @@ class BalRandomForest:
         Returns the ROC curve
         """
         roc = []
-        for t in threshold_arr:
-            roc.append(self.get_ROC_point(x, x_tag, t))
+        for conf_mat in self.get_confusion_matrices(x, x_tag, threshold_arr):
+            precision, recall, fpos_rate = self.get_precision_recall(conf_mat)
+            roc.append([fpos_rate, recall])
         roc = np.array(roc) 
         return roc
 
@@ -210,3 +281,112 @@ class BalRandomForest:
         Pickles the trained model
         """
         pickle.dump(self.estimators, open(fname, 'w'))
+
+    def export_model(self, fname, coordMat, npriceList):
+        """
+        Writes the compiled model, together with the coordMat and 
+        npriceList used for the features, in a model file
+        (see modelFile.py)
+
+        Input:  file name, coordMat and npriceList (arrays)
+        """
+        if self.flat_forest==None:
+            self.compile_model()
+        arrays = self.flat_forest.get_arrays()
+        arrays['coordMat']   = np.asarray(coordMat, dtype=float)
+        arrays['npriceList'] = np.asarray(npriceList, dtype=float)
+        modelFile.write_model(fname, arrays, 
+                              {'max_depth':    self.flat_forest.max_depth,
+                               'n_estimators': len(self.flat_forest)})
+
+    def load_model_file(self, fname):
+        """
+        Loads a model file written by export_model. The node arrays
+        are memory mapped; the sklearn estimators are not available.
+
+        Input:  file name
+        Output: coordMat, npriceList (arrays)
+        """
+        arrays, meta = modelFile.read_model(fname)
+        self.estimators  = []
+        self.flat_forest = flatForest.from_arrays(arrays, meta['max_depth'])
+        return arrays['coordMat'], arrays['npriceList']
+
+
+def get_score_confusion_matrices(score, x_tag, threshold_arr):
+    """
+    Returns the confusion matrices of already computed scores for
+    all the thresholds (a row is classified as scam if its score is
+    >= threshold). The scores are sorted once and the counts below
+    each threshold are read off cumulative sums.
+
+    Input:  score array, class array, array of thresholds
+    Output: array of confusion matrices (n_thresholds x 2 x 2)
+    """
+    score = np.asarray(score)
+    x_tag = np.asarray(x_tag, dtype=float)
+    sort_idx = np.argsort(score, kind='mergesort')
+    cum_scams = np.concatenate(([0.], np.cumsum(x_tag[sort_idx])))
+    cum_legit = np.concatenate(([0.], np.cumsum(1.-x_tag[sort_idx])))
+    # number of rows classified as legit for each threshold
+    n_below = np.searchsorted(score[sort_idx], threshold_arr, side='left')
+    false_negative = cum_scams[n_below]
+    true_negative  = cum_legit[n_below]
+    true_positive  = cum_scams[-1] - false_negative
+    false_positive = cum_legit[-1] - true_negative
+    conf_mat = np.empty((len(n_below), 2, 2))
+    conf_mat[:, 0, 0] = true_negative     #   tn  fn
+    conf_mat[:, 0, 1] = false_negative    #   fp  tp
+    conf_mat[:, 1, 0] = false_positive
+    conf_mat[:, 1, 1] = true_positive
+    return conf_mat
+
+def _get_bal_idx(n_legit, n_scams, train_size, rng):
+    """
+    Returns the row indices of a bootstraped balanced training set
+    drawn from the training part (the held-out tail is left for
+    allocate_test_sample) of the legit rows, followed by the scams 
+    rows, of the training matrix
+    """
+    test_size = int((1.-train_size)*n_scams)
+    train_scams_size = n_scams-test_size
+    train_legit_size = n_legit-test_size
+    # booststrap
+    boot_scams = rng.permutation(train_scams_size)
+    boot_legit = rng.permutation(train_legit_size)
+    rnd_idx = rng.randint(train_scams_size, size=train_scams_size)
+    boot_legit = boot_legit[rnd_idx]
+    rnd_idx = rng.randint(train_scams_size, size=train_scams_size)
+    boot_scams = n_legit + boot_scams[rnd_idx]
+    # join and randomize the sets
+    train_idx = np.concatenate((boot_scams, boot_legit))
+    return train_idx[rng.permutation(len(train_idx))]
+
+def _fit_bal_tree(x, x_tag, n_legit, n_scams, train_size, seed):
+    """
+    Fits one CART on its own balanced bootstrap sample.
+    Everything random in it derives from the seed.
+    """
+    rng = np.random.RandomState(seed)
+    train_idx = _get_bal_idx(n_legit, n_scams, train_size, rng)
+    clf = DecisionTreeClassifier(max_features="auto", random_state=rng)
+    clf.fit(x[train_idx], x_tag[train_idx])
+    return clf
+
+def _init_worker(x, x_tag, n_legit, n_scams, train_size):
+    """
+    Stores the (shared) training matrix in the worker process
+    """
+    _worker_data['x']          = x
+    _worker_data['x_tag']      = x_tag
+    _worker_data['n_legit']    = n_legit
+    _worker_data['n_scams']    = n_scams
+    _worker_data['train_size'] = train_size
+
+def _fit_worker_tree(seed):
+    """
+    Fits one CART in a worker process
+    """
+    return _fit_bal_tree(_worker_data['x'], _worker_data['x_tag'],
+                         _worker_data['n_legit'], _worker_data['n_scams'],
+                         _worker_data['train_size'], seed)
@@ -0,0 +1,216 @@
+#
+# benchmark.py
+#
+# Benchmarks of the scoring and training hot paths, with the
+# json dumps of data/ and test_sample/ as fixtures. The timings
+# are written to a json file that later runs can be compared to.
+#
+#   python benchmark.py run results.json [--quick]
+#   python benchmark.py compare baseline.json results.json [--tolerance 0.2]
+#
+
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import platform
+import tempfile
+from optparse import OptionParser
+import numpy as np
+import sklearn
+import metric
+import reviewTool
+import bRandomForest
+import frontFormating as ff
+
+VERSION = 1
+LEGIT_FILES  = sorted(glob.glob('./data/hist_cl_legit_*.json'))
+SCAMS_FILES  = sorted(glob.glob('./data/hist_cl_scams_*.json'))
+SAMPLE_FILES = ['./test_sample/hist_cl_legit_20130625-1650.json',
+                './test_sample/hist_cl_scams_20130625-1650.json']
+
+def run_benchmarks(quick=False):
+    """
+    Runs all the benchmarks
+
+    Input:  whether to run the short version (fewer repeats
+            and smaller ensembles)
+    Output: dictionary of results by benchmark name
+    """
+    n_repeat = 1 if quick else 3
+    ensemble_sizes = [10, 100] if quick else [10, 100, 1000]
+    results = {}
+
+    ### Ingestion ###
+    results['load_listings'] = time_it(
+        lambda: reviewTool.load_listings(LEGIT_FILES + SCAMS_FILES), n_repeat)
+    legit = reviewTool.load_listings(LEGIT_FILES)
+    scams = reviewTool.load_listings(SCAMS_FILES)
+    results['get_nprice_and_coordMat'] = time_it(
+        lambda: reviewTool.get_nprice_and_coordMat(legit), n_repeat)
+    nprice, coordMat = reviewTool.get_nprice_and_coordMat(legit)
+    coordTree = metric.build_coord_tree(coordMat)
+
+    ### Features ###
+    results['format_metrics'] = time_it(
+        lambda: metric.Metric(legit, coordMat, nprice, coordTree).format_metrics(),
+        n_repeat, n_rows=len(legit))
+    legit_farr = metric.Metric(legit, coordMat, nprice, coordTree).format_metrics()
+    scams_farr = metric.Metric(scams, coordMat, nprice, coordTree).format_metrics()
+    sample = reviewTool.load_listings(SAMPLE_FILES)
+    sample_farr = metric.Metric(sample, coordMat, nprice, coordTree).format_metrics()
+
+    ### Training and prediction ###
+    np.random.seed(0)
+    brf = bRandomForest.BalRandomForest(legit_farr, scams_farr)
+    for n_estimators in ensemble_sizes:
+        results['train_%d' % n_estimators] = time_it(
+            lambda: brf.train(n_estimators), n_repeat)
+        brf.compile_model()
+        results['predict_%d' % n_estimators] = time_it(
+            lambda: brf.predict(sample_farr), n_repeat, n_rows=len(sample_farr))
+        results['predict_%d_early_exit' % n_estimators] = _time_early_exit(
+            brf, sample_farr, n_repeat)
+    results['predict_%d_single' % ensemble_sizes[-1]] = time_it(
+        lambda: [brf.predict(sample_farr[i:i+1]) for i in range(100)],
+        n_repeat, n_rows=100)
+
+    ### Web app ###
+    model_fname = os.path.join(tempfile.mkdtemp(), 'benchmark.lsm')
+    brf.export_model(model_fname, coordMat, nprice)
+    results.update(_run_search_benchmarks(model_fname, sample, n_repeat))
+    os.remove(model_fname)
+    os.rmdir(os.path.dirname(model_fname))
+    return results
+
+def _time_early_exit(brf, x, n_repeat):
+    """
+    Times the early exit prediction at the label thresholds, with
+    the mean number of trees used per row and the fraction of rows
+    getting the same label as with the full prediction
+    """
+    thresholds = (ff.LEGIT_THRESHOLD, ff.SKETCHY_THRESHOLD)
+    result = time_it(lambda: brf.predict_early_exit(x, thresholds),
+                     n_repeat, n_rows=len(x))
+    score, n_used = brf.predict_early_exit(x, thresholds)
+    full_score = brf.predict(x)
+    result['mean_trees'] = float(np.mean(n_used))
+    result['label_agreement'] = float(np.mean(
+        [ff.get_sketchyLevel(s)[1]==ff.get_sketchyLevel(f)[1]
+         for s, f in zip(score, full_score)]))
+    return result
+
+def _run_search_benchmarks(model_fname, sample, n_repeat, n_post=5):
+    """
+    Times the /search-results handler with the scraping stubbed
+    out: the query returns n_post listings of the test sample
+    """
+    os.environ['LESSSKETCHY_MODEL'] = model_fname
+    import query
+    import run_flask
+    listing_json = [dict(row) for i, row in sample.head(n_post).iterrows()]
+    query.Query.scrape = lambda self, *args, **kwargs: \
+                         [dict(post) for post in listing_json]
+    client = run_flask.app.test_client()
+    def search(clear_cache):
+        if clear_cache:
+            run_flask.score_cache.clear()
+        response = client.get('/search-results?text=studio+mission')
+        if response.status_code!=200:
+            raise RuntimeError("/search-results returned %d" % response.status_code)
+    results = {}
+    results['search_results'] = time_it(lambda: search(True), 10*n_repeat, n_rows=n_post)
+    results['search_results_cached'] = time_it(lambda: search(False), 10*n_repeat, n_rows=n_post)
+    return results
+
+def time_it(func, n_repeat=3, n_rows=None):
+    """
+    Times a function (wall clock, best and median of n_repeat runs)
+
+    Output: dictionary of timings (seconds)
+    """
+    timings = []
+    for n in range(n_repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    result = {'best': min(timings), 'median': float(np.median(timings)),
+              'n_repeat': n_repeat}
+    if n_rows!=None:
+        result['rows_per_sec'] = n_rows/result['median'] if result['median']>0 else None
+    return result
+
+def get_environment():
+    """
+    Describes the machine and library versions of a run
+    """
+    import multiprocessing
+    return {'host': socket.gethostname(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'sklearn': sklearn.__version__,
+            'n_cpu': multiprocessing.cpu_count(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+def compare_results(baseline, results, tolerance=0.2, min_diff=0.002,
+                    agreement_tolerance=0.005):
+    """
+    Compares the median timings of two runs. Slow downs of less
+    than min_diff seconds are timer noise, not regressions. The
+    early exit predictions also regress if their label agreement
+    drops by more than agreement_tolerance.
+
+    Input:  baseline and new results (as written by the run mode),
+            relative slow down tolerated, absolute slow down ignored,
+            label agreement drop tolerated
+    Output: list of (name, baseline median, new median, ratio, regressed)
+    """
+    comparison = []
+    for name in sorted(set(baseline['results']) & set(results['results'])):
+        base_time = baseline['results'][name]['median']
+        new_time  = results['results'][name]['median']
+        ratio = new_time/base_time if base_time>0 else float('inf')
+        regressed = ratio>1.+tolerance and new_time-base_time>min_diff
+        if 'label_agreement' in baseline['results'][name] and \
+           'label_agreement' in results['results'][name]:
+            regressed |= results['results'][name]['label_agreement'] < \
+                         baseline['results'][name]['label_agreement'] - agreement_tolerance
+        comparison.append((name, base_time, new_time, ratio, regressed))
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="python benchmark.py run results.json [--quick]\n"
+                                "       python benchmark.py compare baseline.json "
+                                "results.json [--tolerance 0.2]")
+    parser.add_option('--quick', action='store_true', default=False,
+                      help="fewer repeats and no 1000-tree ensemble")
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help="relative slow down flagged as a regression (default 0.2)")
+    options, args = parser.parse_args()
+    if len(args)==2 and args[0]=='run':
+        results = run_benchmarks(options.quick)
+        out = open(args[1], 'w')
+        json.dump({'version': VERSION, 'environment': get_environment(),
+                   'results': results}, out, indent=2, sort_keys=True)
+        out.close()
+        for name in sorted(results):
+            print "%-28s %9.4f s" % (name, results[name]['median']),
+            if 'label_agreement' in results[name]:
+                print "%6.1f trees/row, %.4f label agreement" % (
+                    results[name]['mean_trees'], results[name]['label_agreement']),
+            print
+        print "<> Results written to", args[1]
+    elif len(args)==3 and args[0]=='compare':
+        baseline = json.load(open(args[1], 'r'))
+        results  = json.load(open(args[2], 'r'))
+        comparison = compare_results(baseline, results, options.tolerance)
+        for name, base_time, new_time, ratio, regressed in comparison:
+            print "%-28s %9.4f s %9.4f s %6.2fx%s" % (name, base_time, new_time,
+                                                    ratio, '  REGRESSION' if regressed else '')
+        n_regressed = sum(1 for row in comparison if row[-1])
+        print "<> %d regression(s) over %d%%" % (n_regressed, int(options.tolerance*100))
+        sys.exit(1 if n_regressed>0 else 0)
+    else:
+        parser.print_usage()
+        sys.exit(1)
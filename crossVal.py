@@ -0,0 +1,241 @@
+#
+# crossVal.py
+#
+# Stratified k-fold cross-validation of the balanced random
+# forest. The features are computed once by the caller, put in
+# shared memory and the folds are trained and scored concurrently
+# by a pool of worker processes (or one after the other, with the
+# trees of each forest spread over the workers, when there are
+# more workers than folds).
+#
+
+import time
+import multiprocessing as mp
+import numpy as np
+import bRandomForest
+import sharedArray
+
+# Feature matrix and folds of the worker processes (set by _init_worker)
+_worker_data = {}
+
+def cross_validate(legit_farr, scams_farr, n_folds=4, n_estimators=1000,
+                   n_jobs=None, threshold=0.5, threshold_arr=np.arange(0.01, 1, 0.01)):
+    """
+    Cross-validates the balanced random forest. The legit and scams
+    rows are each split in n_folds folds; every fold is scored by a
+    forest trained on the other ones, so every row is scored once.
+    Each fold gets its own seed (drawn from numpy's global generator),
+    so the results do not depend on the number of workers.
+
+    As the test sample of trainModel.py (allocate_test_sample), each
+    fold is measured on a balanced subsample: all its scams rows and
+    as many randomly drawn legit rows. The metrics of all the rows of
+    the folds are reported under 'full': there are many more legit
+    than scams rows, so their precision is much lower.
+
+    With up to n_folds workers, the folds are trained concurrently
+    (one process per fold); with more, the folds are trained one
+    after the other, each by all the workers (one tree per task).
+
+    Input:  legit feature array, scams feature array (no class tags!),
+            number of folds, number of estimators per forest, number
+            of worker processes (None for one per core), threshold of
+            the precision and recall, thresholds of the ROC curves
+    Output: dictionary with 'folds' (list of the fold results, see
+            get_score_metrics, with 'train_time', 'predict_time',
+            'n_test' and 'full') and 'aggregate' (metrics of the pooled 
+            scores, with the mean and std over the folds of each of 
+            them, and 'full')
+    """
+    n_legit = len(legit_farr)
+    n_scams = len(scams_farr)
+    if n_folds<2 or n_folds>min(n_legit, n_scams):
+        raise ValueError("Cannot make %d folds of %d legit and %d scams rows"
+                         % (n_folds, n_legit, n_scams))
+    fold_idx = np.concatenate((_get_fold_idx(n_legit, n_folds),
+                               _get_fold_idx(n_scams, n_folds)))
+    x_tag = np.concatenate((np.zeros(n_legit), np.ones(n_scams)))
+    seeds = np.random.randint(np.iinfo(np.int32).max, size=n_folds)
+    bal_idx = [_get_bal_test_idx(fold_idx, x_tag, fold) for fold in range(n_folds)]
+    if n_jobs==None:
+        n_jobs = mp.cpu_count()
+    tree_jobs = n_jobs if n_jobs>n_folds else 1
+    tasks = [(fold, seeds[fold], n_estimators, tree_jobs) for fold in range(n_folds)]
+    if n_jobs==1 or n_jobs>n_folds:
+        # the worker processes (if any) are the ones of the trees
+        _init_worker(np.concatenate((legit_farr, scams_farr), axis=0),
+                     x_tag, fold_idx)
+        fold_out = [_run_fold(task) for task in tasks]
+    else:
+        # the features go to the workers once, in shared memory
+        x = sharedArray.share_array(np.concatenate((legit_farr, scams_farr), axis=0))
+        pool = mp.Pool(n_jobs, initializer=_init_worker,
+                       initargs=(x, sharedArray.share_array(x_tag),
+                                 sharedArray.share_array(fold_idx, int)))
+        try:
+            fold_out = pool.map(_run_fold, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    folds = []
+    score = np.empty(len(x_tag))
+    for fold, (fold_score, train_time, predict_time) in enumerate(fold_out):
+        test_idx = np.flatnonzero(fold_idx==fold)
+        score[test_idx] = fold_score
+        result = get_score_metrics(score[bal_idx[fold]], x_tag[bal_idx[fold]],
+                                   threshold, threshold_arr)
+        result['train_time']   = train_time
+        result['predict_time'] = predict_time
+        result['n_test']       = len(bal_idx[fold])
+        result['full'] = get_score_metrics(fold_score, x_tag[test_idx],
+                                           threshold, threshold_arr)
+        result['full']['n_test'] = len(test_idx)
+        folds.append(result)
+    all_bal_idx = np.concatenate(bal_idx)
+    aggregate = get_score_metrics(score[all_bal_idx], x_tag[all_bal_idx],
+                                  threshold, threshold_arr)
+    aggregate['full'] = get_score_metrics(score, x_tag, threshold, threshold_arr)
+    for name in ('precision', 'recall', 'fpos_rate', 'fscore', 'auc'):
+        for agg, results in ((aggregate, folds),
+                             (aggregate['full'], [result['full'] for result in folds])):
+            values = [result[name] for result in results]
+            agg[name+'_mean'] = np.mean(values)
+            agg[name+'_std']  = np.std(values)
+    for name in ('train_time', 'predict_time'):
+        values = [result[name] for result in folds]
+        aggregate[name+'_mean'] = np.mean(values)
+        aggregate[name+'_std']  = np.std(values)
+    return {'folds': folds, 'aggregate': aggregate}
+
+def get_score_metrics(score, x_tag, threshold=0.5, threshold_arr=np.arange(0.01, 1, 0.01)):
+    """
+    Returns the validation metrics of already computed scores
+
+    Input:  score array, class array, threshold of the precision
+            and recall, thresholds of the ROC curve
+    Output: dictionary of precision, recall, fpos_rate, fscore,
+            roc (fpos_rate, recall for each threshold of threshold_arr)
+            and auc (area under the ROC curve of all the thresholds)
+    """
+    conf_mat = bRandomForest.get_score_confusion_matrices(score, x_tag, [threshold])[0]
+    tn, fn = conf_mat[0]
+    fp, tp = conf_mat[1]
+    precision = tp/(tp + fp)
+    recall    = tp/(tp + fn)
+    fpos_rate = fp/(tn + fp)
+    fscore = 2.*(precision*recall)/(precision+recall)
+    return {'precision': precision, 'recall': recall, 'fpos_rate': fpos_rate,
+            'fscore': fscore, 'roc': _get_roc(score, x_tag, threshold_arr),
+            'auc': get_auc(score, x_tag)}
+
+def get_auc(score, x_tag):
+    """
+    Returns the area under the ROC curve, with every distinct
+    score as threshold (ties count as half)
+    """
+    thresholds = np.concatenate((np.unique(score), [np.inf]))
+    roc = _get_roc(score, x_tag, thresholds)
+    # the thresholds are increasing, so the false positive rates decrease
+    return -np.trapz(roc[:, 1], roc[:, 0])
+
+def print_report(results):
+    """
+    Prints the fold and aggregate metrics of cross_validate: on the
+    balanced test subsamples, then on all the rows of the folds
+    """
+    print "<> Balanced test subsamples (as many legit as scams rows)"
+    print "%-9s %7s %9s %9s %9s %9s %9s %9s" % ('fold', 'n_test', 'precision',
+        'recall', 'fscore', 'auc', 'train_s', 'predict_s')
+    for fold, result in enumerate(results['folds']):
+        print "%-9d %7d %9.4f %9.4f %9.4f %9.4f %9.2f %9.2f" % (fold,
+            result['n_test'], result['precision'], result['recall'],
+            result['fscore'], result['auc'], result['train_time'],
+            result['predict_time'])
+    aggregate = results['aggregate']
+    print "%-9s %7s %9.4f %9.4f %9.4f %9.4f" % ('pooled', '', aggregate['precision'],
+        aggregate['recall'], aggregate['fscore'], aggregate['auc'])
+    print "%-9s %7s %9.4f %9.4f %9.4f %9.4f %9.2f %9.2f" % ('mean', '',
+        aggregate['precision_mean'], aggregate['recall_mean'],
+        aggregate['fscore_mean'], aggregate['auc_mean'],
+        aggregate['train_time_mean'], aggregate['predict_time_mean'])
+    print "%-9s %7s %9.4f %9.4f %9.4f %9.4f %9.2f %9.2f" % ('std', '',
+        aggregate['precision_std'], aggregate['recall_std'],
+        aggregate['fscore_std'], aggregate['auc_std'],
+        aggregate['train_time_std'], aggregate['predict_time_std'])
+    print "<> All the rows of the folds"
+    print "%-9s %7s %9s %9s %9s %9s" % ('fold', 'n_test', 'precision',
+        'recall', 'fscore', 'auc')
+    for fold, result in enumerate(results['folds']):
+        full = result['full']
+        print "%-9d %7d %9.4f %9.4f %9.4f %9.4f" % (fold, full['n_test'],
+            full['precision'], full['recall'], full['fscore'], full['auc'])
+    full = aggregate['full']
+    print "%-9s %7s %9.4f %9.4f %9.4f %9.4f" % ('pooled', '', full['precision'],
+        full['recall'], full['fscore'], full['auc'])
+    print "%-9s %7s %9.4f %9.4f %9.4f %9.4f" % ('mean', '', full['precision_mean'],
+        full['recall_mean'], full['fscore_mean'], full['auc_mean'])
+    print "%-9s %7s %9.4f %9.4f %9.4f %9.4f" % ('std', '', full['precision_std'],
+        full['recall_std'], full['fscore_std'], full['auc_std'])
+
+def _get_fold_idx(n_rows, n_folds):
+    """
+    Returns the fold of each row: the folds are of equal
+    size (up to one row) and randomly assigned
+    """
+    return np.random.permutation(np.arange(n_rows) % n_folds)
+
+def _get_bal_test_idx(fold_idx, x_tag, fold):
+    """
+    Returns the rows of a balanced subsample of the fold: as many
+    legit as scams rows (the larger class is randomly subsampled)
+    """
+    legit_idx = np.flatnonzero((fold_idx==fold) & (x_tag==0))
+    scams_idx = np.flatnonzero((fold_idx==fold) & (x_tag==1))
+    n_test = min(len(legit_idx), len(scams_idx))
+    return np.sort(np.concatenate((np.random.permutation(legit_idx)[:n_test],
+                                   np.random.permutation(scams_idx)[:n_test])))
+
+def _get_roc(score, x_tag, threshold_arr):
+    """
+    Returns the ROC points (fpos_rate, recall) of the thresholds
+    """
+    conf_mat = bRandomForest.get_score_confusion_matrices(score, x_tag, threshold_arr)
+    recall    = conf_mat[:, 1, 1]/(conf_mat[:, 1, 1] + conf_mat[:, 0, 1])
+    fpos_rate = conf_mat[:, 1, 0]/(conf_mat[:, 0, 0] + conf_mat[:, 1, 0])
+    return np.column_stack((fpos_rate, recall))
+
+def _init_worker(x, x_tag, fold_idx):
+    """
+    Stores the (shared) features, tags and folds in the worker process
+    """
+    _worker_data['x']        = x
+    _worker_data['x_tag']    = x_tag
+    _worker_data['fold_idx'] = fold_idx
+
+def _run_fold(task):
+    """
+    Trains a forest on all the folds but one and scores that one
+
+    Input:  (fold, seed, number of estimators, number of worker
+            processes of the trees)
+    Output: scores of the fold rows (in row order), training
+            and prediction times (seconds)
+    """
+    fold, seed, n_estimators, n_jobs = task
+    np.random.seed(seed)
+    x        = _worker_data['x']
+    x_tag    = _worker_data['x_tag']
+    is_test  = _worker_data['fold_idx']==fold
+    is_legit = x_tag==0
+    start = time.time()
+    # all the training rows are used (no held-out tail)
+    brf = bRandomForest.BalRandomForest(x[~is_test & is_legit], x[~is_test & ~is_legit],
+                                        train_size=1.)
+    brf.train(n_estimators, n_jobs)
+    brf.compile_model()
+    train_time = time.time() - start
+    start = time.time()
+    score = brf.predict(x[is_test])
+    predict_time = time.time() - start
+    return score, train_time, predict_time
@@ -0,0 +1,377 @@
+#
+# fetchTool.py
+#
+# Fetching of craigslist pages: keep-alive connections
+# (pooled by host and shared by all the threads), timeouts,
+# a bounded pool of threads for concurrent fetches and a
+# shared on-disk page cache.
+#
+
+import os
+import time
+import json
+import hashlib
+import httplib
+import socket
+import threading
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+USER_AGENT = 'Mozilla/5.0 (compatible; LessSketchy)'
+_MAX_REDIRECTS = 5
+# idle keep-alive connections kept per host
+_MAX_IDLE = 16
+
+# idle keep-alive connections, by (scheme, host): they outlive the
+# threads (and thread pools) that opened them
+_idle_connections = {}
+_connections_lock = threading.Lock()
+
+class FetchError(IOError):
+    """
+    Raised when a page cannot be fetched
+    """
+    pass
+
+class RateLimiter:
+    """
+    Politeness limit shared by all the fetching threads:
+    requests are spaced by at least 1/rate seconds
+    """
+
+    def __init__(self, rate):
+        """
+        Input:  maximum number of requests per second
+        """
+        self.interval = 1./rate
+        self._next_time = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        Blocks until the next request is allowed
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        finally:
+            self._lock.release()
+        if wait_time>0:
+            time.sleep(wait_time)
+
+class PageCache:
+    """
+    Content-addressed disk cache of fetched pages, shared by all 
+    the tools (and processes) using the same directory. Each page is 
+    stored under the sha1 of its url with the validators (ETag and 
+    Last-Modified) of the response. Pages younger than the ttl are 
+    served without any request; older ones are revalidated with a 
+    conditional request. The least recently used pages are evicted 
+    when the cache grows over max_bytes. Each process counts its own
+    writes and re-checks the size on disk (with the writes of the
+    other processes) every check_interval seconds and before evicting,
+    so the cache can only go over max_bytes by what the other processes
+    wrote since the last check.
+    """
+
+    def __init__(self, path, ttl=3600, max_bytes=512*1024*1024, check_interval=60):
+        """
+        Input:  cache directory, time to live of a page (seconds),
+                maximum size of the cached pages (bytes), time between
+                two checks of the size on disk (seconds)
+        """
+        self.path = path
+        self.ttl  = ttl
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        # fresh pages served, pages revalidated (304) and pages fetched
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._evict()
+
+    def get(self, url):
+        """
+        Returns the cached page and its meta data (None if not cached)
+        """
+        page_fname, meta_fname = self._get_fnames(url)
+        try:
+            meta = json.load(open(meta_fname, 'r'))
+            body = open(page_fname, 'rb').read()
+        except (IOError, ValueError):
+            return None
+        if meta.get('url')!=url:
+            return None
+        # the page modification time is the LRU clock
+        _touch(page_fname)
+        return body, meta
+
+    def is_fresh(self, meta):
+        """
+        Whether a cached page can be used without revalidation
+        """
+        return time.time() - meta['fetched'] < self.ttl
+
+    def put(self, url, body, headers):
+        """
+        Stores the page with the validators of the response headers
+        """
+        page_fname, meta_fname = self._get_fnames(url)
+        meta = {'url': url, 'fetched': time.time(),
+                'etag': headers.get('etag'),
+                'last_modified': headers.get('last-modified')}
+        if not os.path.isdir(os.path.dirname(page_fname)):
+            try:
+                os.makedirs(os.path.dirname(page_fname))
+            except OSError:
+                pass
+        old_size = os.path.getsize(page_fname) if os.path.exists(page_fname) else 0
+        _write_atomic(page_fname, body)
+        _write_atomic(meta_fname, json.dumps(meta))
+        self._lock.acquire()
+        try:
+            self._size += len(body) - old_size
+            if self._size>self.max_bytes or \
+               time.time() - self._checked>self.check_interval:
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def refresh(self, url, meta):
+        """
+        Marks a revalidated (304) page as freshly fetched
+        """
+        page_fname, meta_fname = self._get_fnames(url)
+        meta['fetched'] = time.time()
+        _write_atomic(meta_fname, json.dumps(meta))
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        """
+        Re-checks the size of the cache on disk and, if it is over its
+        maximum size, removes the least recently used pages until it
+        is 10% below
+        """
+        pages = []
+        for fname in self._list_pages():
+            try:
+                pages.append((os.path.getmtime(fname), os.path.getsize(fname), fname))
+            except OSError:
+                continue
+        self._size = sum(page[1] for page in pages)
+        self._checked = time.time()
+        if self._size<=self.max_bytes:
+            return
+        pages.sort()
+        for mtime, size, fname in pages:
+            if self._size<=0.9*self.max_bytes:
+                break
+            for rm_fname in (fname, fname[:-len('.page')] + '.meta'):
+                try:
+                    os.remove(rm_fname)
+                except OSError:
+                    pass
+            self._size -= size
+
+    def _get_fnames(self, url):
+        key = hashlib.sha1(url).hexdigest()
+        base = os.path.join(self.path, key[:2], key)
+        return base + '.page', base + '.meta'
+
+    def _list_pages(self):
+        for dirpath, dirnames, fnames in os.walk(self.path):
+            for fname in fnames:
+                if fname.endswith('.page'):
+                    yield os.path.join(dirpath, fname)
+
+def fetch_page(url, timeout=10, limiter=None, cache=None):
+    """
+    Fetches a page reusing an idle keep-alive connection to
+    that host. Redirects are followed.
+    With a PageCache, fresh pages cost no request and stale
+    ones a conditional request.
+
+    Input:  url, timeout in seconds, RateLimiter (optional),
+            PageCache (optional)
+    Output: page content (string)
+    """
+    cached = None
+    req_headers = {}
+    if cache is not None:
+        cached = cache.get(url)
+        if cached is not None:
+            body, meta = cached
+            if cache.is_fresh(meta):
+                cache._count('hits')
+                return body
+            if meta.get('etag'):
+                req_headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                req_headers['If-Modified-Since'] = meta['last_modified']
+    req_url = url
+    for n in range(_MAX_REDIRECTS+1):
+        if limiter is not None:
+            limiter.wait()
+        status, headers, body = _request(req_url, timeout, req_headers)
+        if status in (301, 302, 303, 307) and headers.get('location'):
+            req_url = urlparse.urljoin(req_url, headers['location'])
+            continue
+        if status==304 and cached is not None:
+            cache.refresh(url, cached[1])
+            cache._count('revalidations')
+            return cached[0]
+        if status!=200:
+            raise FetchError("HTTP %d for %s" % (status, req_url))
+        if cache is not None:
+            cache.put(url, body, headers)
+            cache._count('misses')
+        return body
+    raise FetchError("Too many redirects for %s" % url)
+
+def iter_pages(urls, n_workers=8, timeout=10, skip_errors=False, 
+               limiter=None, cache=None):
+    """
+    Fetches the pages with a bounded pool of threads and yields
+    them in the order of the urls, as soon as they are available
+
+    Input:  list of urls, number of threads, timeout in seconds,
+            whether a failed fetch yields None instead of raising,
+            RateLimiter (optional), PageCache (optional)
+    Output: generator of page contents
+    """
+    fetch = _fetch_or_none if skip_errors else fetch_page
+    if n_workers<=1:
+        for url in urls:
+            yield fetch(url, timeout, limiter, cache)
+        return
+    pool = ThreadPool(n_workers)
+    try:
+        for page in pool.imap(lambda url: fetch(url, timeout, limiter, cache), urls):
+            yield page
+    finally:
+        pool.terminate()
+
+def fetch_pages(urls, n_workers=8, timeout=10, skip_errors=False, 
+                limiter=None, cache=None):
+    """
+    Fetches the pages concurrently (see iter_pages)
+
+    Output: list of page contents
+    """
+    return list(iter_pages(urls, n_workers, timeout, skip_errors, limiter, cache))
+
+def _fetch_or_none(url, timeout, limiter=None, cache=None):
+    try:
+        return fetch_page(url, timeout, limiter, cache)
+    except (FetchError, httplib.HTTPException, socket.error):
+        return None
+
+def _request(url, timeout, headers=None):
+    """
+    Sends a GET request on an idle keep-alive connection to the
+    host, which is given back to the pool afterwards. A connection
+    dropped by the server is replaced once.
+
+    Output: status, headers (dict, lower case names), body
+    """
+    parsed = urlparse.urlsplit(url)
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    req_headers = {'User-Agent': USER_AGENT, 'Connection': 'keep-alive'}
+    req_headers.update(headers or {})
+    for attempt in range(2):
+        conn, is_new = _get_connection(parsed.scheme, parsed.netloc, timeout)
+        try:
+            conn.request('GET', path, headers=req_headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if is_new or attempt>0:
+                raise
+            continue
+        if response.getheader('connection', '').lower()=='close':
+            conn.close()
+        else:
+            _release_connection(parsed.scheme, parsed.netloc, conn)
+        return response.status, dict(response.getheaders()), body
+
+def close_connections():
+    """
+    Closes all the idle keep-alive connections
+    """
+    _connections_lock.acquire()
+    try:
+        conns = [conn for idle in _idle_connections.values() for conn in idle]
+        _idle_connections.clear()
+    finally:
+        _connections_lock.release()
+    for conn in conns:
+        conn.close()
+
+def _get_connection(scheme, host, timeout):
+    """
+    Takes the most recently used idle connection to the host (or
+    opens one) and returns it with whether it was just opened
+    """
+    _connections_lock.acquire()
+    try:
+        idle = _idle_connections.get((scheme, host))
+        conn = idle.pop() if idle else None
+    finally:
+        _connections_lock.release()
+    if conn is not None:
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, False
+    if scheme=='https':
+        conn = httplib.HTTPSConnection(host, timeout=timeout)
+    else:
+        conn = httplib.HTTPConnection(host, timeout=timeout)
+    return conn, True
+
+def _release_connection(scheme, host, conn):
+    """
+    Gives a connection back to the idle ones of the host
+    (it is closed if there are already enough of them)
+    """
+    _connections_lock.acquire()
+    try:
+        idle = _idle_connections.setdefault((scheme, host), [])
+        if len(idle)<_MAX_IDLE:
+            idle.append(conn)
+            conn = None
+    finally:
+        _connections_lock.release()
+    if conn is not None:
+        conn.close()
+
+def _touch(fname):
+    try:
+        os.utime(fname, None)
+    except OSError:
+        pass
+
+def _write_atomic(fname, content):
+    """
+    Writes the file under a temporary name and renames it, so that
+    concurrent readers never see a partial file
+    """
+    tmp_fname = '%s.%d.%d.tmp' % (fname, os.getpid(), threading.current_thread().ident)
+    out = open(tmp_fname, 'wb')
+    out.write(content)
+    out.close()
+    os.rename(tmp_fname, fname)
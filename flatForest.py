@@ -0,0 +1,190 @@
+#
+# flatForest.py
+#
+# A compiled version of an ensemble of scikit-learn CARTs.
+# All the trees are packed into contiguous node arrays and
+# evaluated for a whole batch at once.
+#
+
+import numpy as np
+
+class FlatForest:
+    """
+    Flat-array representation of an ensemble of decision trees.
+    Node i of the ensemble is described by feature[i], threshold[i],
+    left[i], right[i] and value[i]. Leaves have a negative feature.
+    """
+
+    def __init__(self, feature, threshold, left, right, value, roots, max_depth):
+        """
+        Initializes the flat forest from the node arrays
+
+        Input:  node arrays (feature, threshold, left, right, value),
+                root node of each tree, maximum depth of the trees
+        """
+        self.feature   = feature
+        self.threshold = threshold
+        self.left      = left
+        self.right     = right
+        self.value     = value
+        self.roots     = roots
+        self.max_depth = int(max_depth)
+
+    def __len__(self):
+        return len(self.roots)
+
+    def get_arrays(self):
+        """
+        Returns the node arrays (e.g. to be written in a model file)
+        """
+        return {'feature':   self.feature,
+                'threshold': self.threshold,
+                'left':      self.left,
+                'right':     self.right,
+                'value':     self.value,
+                'roots':     self.roots}
+
+    def predict(self, x, chunk_size=128):
+        """
+        Returns the prediction (betwen 0 and 1), i.e. the mean of
+        the tree predictions
+
+        Input:  feature array, number of rows evaluated at once
+        Output: array of predictions
+        """
+        x = self._check_input(x)
+        prediction = np.zeros(len(x))
+        for start in range(0, len(x), chunk_size):
+            leaf_value = self.predict_trees(x[start:start+chunk_size])
+            prediction[start:start+chunk_size] = np.mean(leaf_value, axis=0)
+        return prediction
+
+    def predict_early_exit(self, x, thresholds, block_size=50, delta=0.01):
+        """
+        Returns the predictions evaluating the trees by blocks and
+        stopping, for each row, as soon as its final prediction is
+        known to be on the same side of all the thresholds.
+        The trees vote 0 or 1 and are visited in a fixed random order,
+        so the first k votes are a sample without replacement of all
+        the votes. After each block the final mean is bounded by the
+        Hoeffding-Serfling inequality (and by the votes left); the
+        bound holds for all the blocks with probability 1-delta.
+        The prediction of a row that exits early is the mean of the
+        votes so far.
+
+        Input:  feature array, label thresholds, number of trees per
+                block, probability that a row exits on the wrong side
+                of a threshold
+        Output: array of predictions, number of trees used per row
+        """
+        x = self._check_input(x)
+        thresholds = np.asarray(thresholds, dtype=float)
+        n_trees = len(self.roots)
+        order = self.roots[np.random.RandomState(0).permutation(n_trees)]
+        log_term = np.log(2.*int(np.ceil(n_trees/float(block_size)))/delta)
+        vote_sum = np.zeros(len(x))
+        n_used = np.zeros(len(x), dtype=int)
+        active = np.arange(len(x))
+        for start in range(0, n_trees, block_size):
+            roots = order[start:start+block_size]
+            vote_sum[active] += self.predict_trees(x[active], roots).sum(axis=0)
+            n_used[active] += len(roots)
+            k = start + len(roots)
+            if k==n_trees:
+                break
+            eps = np.sqrt((1.-(k-1.)/n_trees)*log_term/(2.*k))
+            votes = vote_sum[active]
+            lo = np.maximum(votes/k - eps, votes/n_trees)
+            hi = np.minimum(votes/k + eps, (votes + n_trees - k)/n_trees)
+            undecided = np.zeros(len(active), dtype=bool)
+            for t in thresholds:
+                undecided |= (lo<=t) & (hi>=t)
+            active = active[undecided]
+            if len(active)==0:
+                break
+        return vote_sum/n_used, n_used
+
+    def predict_trees(self, x, roots=None):
+        """
+        Returns the prediction of every tree for every row
+
+        Input:  feature array, root nodes of the trees to
+                evaluate (default all of them)
+        Output: array of tree predictions (n_trees x n_rows)
+        """
+        x = self._check_input(x)
+        if roots is None:
+            roots = self.roots
+        n_rows, n_features = x.shape
+        x_flat  = x.ravel()
+        node    = np.repeat(np.asarray(roots, dtype=np.int64), n_rows)
+        row_off = np.tile(np.arange(n_rows)*n_features, len(roots))
+        # walk all the trees level by level, only following
+        # the (tree, row) pairs that have not reached a leaf yet
+        active = np.arange(len(node))
+        for depth in range(self.max_depth+1):
+            curr = node[active]
+            feature = self.feature[curr]
+            not_leaf = (feature>=0)
+            active  = active[not_leaf]
+            if len(active)==0:
+                break
+            curr = curr[not_leaf]
+            go_left = x_flat[row_off[active]+feature[not_leaf]] <= self.threshold[curr]
+            node[active] = np.where(go_left, self.left[curr], self.right[curr])
+        return self.value[node].reshape(len(roots), n_rows)
+
+    def _check_input(self, x):
+        """
+        The trees are evaluated in single precision, as in scikit-learn
+        (and then widened so the comparison with the thresholds is exact)
+        """
+        x = np.atleast_2d(np.asarray(x, dtype=np.float32))
+        return np.ascontiguousarray(x, dtype=np.float64)
+
+
+def compile_estimators(estimators):
+    """
+    Packs a list of trained DecisionTreeClassifier into a FlatForest
+
+    Input:  list of trained estimators
+    Output: FlatForest
+    """
+    feature   = []
+    threshold = []
+    left      = []
+    right     = []
+    value     = []
+    roots     = []
+    max_depth = 0
+    offset = 0
+    for clf in estimators:
+        tree = clf.tree_
+        n_nodes = tree.node_count
+        is_leaf = (tree.children_left==-1)
+        feature.append(np.where(is_leaf, -1, tree.feature))
+        threshold.append(tree.threshold)
+        left.append(np.where(is_leaf, -1, tree.children_left+offset))
+        right.append(np.where(is_leaf, -1, tree.children_right+offset))
+        # same as clf.predict: the class with the largest count
+        value.append(clf.classes_.take(np.argmax(tree.value[:, 0, :], axis=1)))
+        roots.append(offset)
+        max_depth = max(max_depth, tree.max_depth)
+        offset += n_nodes
+    if len(roots)==0:
+        raise ValueError("No estimators to compile")
+    return FlatForest(np.concatenate(feature).astype(np.int32),
+                      np.concatenate(threshold).astype(np.float64),
+                      np.concatenate(left).astype(np.int64),
+                      np.concatenate(right).astype(np.int64),
+                      np.concatenate(value).astype(np.float64),
+                      np.array(roots, dtype=np.int64),
+                      max_depth)
+
+def from_arrays(arrays, max_depth):
+    """
+    Builds a FlatForest from the node arrays (see FlatForest.get_arrays)
+    """
+    return FlatForest(arrays['feature'], arrays['threshold'],
+                      arrays['left'], arrays['right'], arrays['value'],
+                      arrays['roots'], max_depth)
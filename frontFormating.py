@@ -5,12 +5,16 @@
 # related needs of the front end.
 #
 
+# scores at or above are sketchy, at or below are legit
+SKETCHY_THRESHOLD = 0.65
+LEGIT_THRESHOLD   = 0.40
+
 def get_sketchyLevel(score):
     """Returns the sketchy labels"""
     label = []
-    if score>=0.65:
+    if score>=SKETCHY_THRESHOLD:
         label = ['btn btn-danger btn-mini', 'Sketchy']
-    elif score<=0.40:
+    elif score<=LEGIT_THRESHOLD:
         label = ['btn btn-success btn-mini', 'Seems Legit']
     else:
         label = ['btn btn-warning btn-mini', 'Hard to tell']
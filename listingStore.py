@@ -0,0 +1,175 @@
+#
+# listingStore.py
+#
+# Columnar, appendable storage of the scraped listings.
+# Each numeric column is a flat binary file and each text
+# column a utf-8 blob with an index of end offsets. Columns
+# are read back with numpy.memmap, only the ones asked for.
+#
+
+import os
+import sys
+import json
+import numpy as np
+import pandas as pd
+
+VERSION = 1
+NUMERIC_COLUMNS = [('pid',     '<i8'),
+                   ('lat',     '<f8'),
+                   ('lon',     '<f8'),
+                   ('price',   '<f8'),
+                   ('nbr',     '<i4'),
+                   ('phone',   '<i8'),
+                   ('hasPost', '<i1')]
+TEXT_COLUMNS = ['head', 'link', 'post']
+
+class ListingStore:
+    """
+    A directory holding the listings column by column.
+    New scrape batches are appended (pids already stored are
+    skipped); the number of rows in meta.json is only updated
+    once all the columns are written, so a failed append is
+    ignored by the readers and repaired by the next append.
+    """
+
+    def __init__(self, path):
+        """
+        Opens (or creates) the store
+
+        Input:  store directory
+        """
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        meta_fname = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_fname):
+            meta = json.load(open(meta_fname, 'r'))
+            if meta['version']!=VERSION:
+                raise ValueError("Unsupported listing store version %d"
+                                 % meta['version'])
+            self.n_rows = meta['n_rows']
+        else:
+            self.n_rows = 0
+            self._write_meta()
+
+    def __len__(self):
+        return self.n_rows
+
+    def append(self, listing):
+        """
+        Appends a batch of listings
+
+        Input:  listing (pd dataframe or json list)
+        Output: number of rows appended
+        """
+        if type(listing)!=pd.core.frame.DataFrame:
+            listing = pd.DataFrame(listing)
+        if len(listing)==0:
+            return 0
+        self._repair()
+        # skip the pids already stored (or repeated in the batch)
+        pid = np.asarray(listing['pid'], dtype='<i8')
+        new_idx = ~np.in1d(pid, self.get_column('pid'))
+        new_idx &= ~pd.Series(pid).duplicated().values
+        listing = listing[new_idx]
+        n_new = len(listing)
+        if n_new==0:
+            return 0
+        for name, dtype in NUMERIC_COLUMNS:
+            out = open(self._fname(name, '.bin'), 'ab')
+            np.asarray(listing[name], dtype=dtype).tofile(out)
+            out.close()
+        for name in TEXT_COLUMNS:
+            blob_fname = self._fname(name, '.txt')
+            offset = os.path.getsize(blob_fname) if os.path.exists(blob_fname) else 0
+            encoded = [(text or u'').encode('utf-8') for text in listing[name]]
+            end_offsets = offset + np.cumsum([len(text) for text in encoded])
+            out = open(blob_fname, 'ab')
+            out.write(''.join(encoded))
+            out.close()
+            out = open(self._fname(name, '.off'), 'ab')
+            np.asarray(end_offsets, dtype='<i8').tofile(out)
+            out.close()
+        self.n_rows += n_new
+        self._write_meta()
+        return n_new
+
+    def read(self, columns=None):
+        """
+        Reads the listings, only with the columns asked for
+
+        Input:  list of column names (default all of them)
+        Output: pandas dataframe
+        """
+        if columns==None:
+            columns = [name for name, dtype in NUMERIC_COLUMNS] + TEXT_COLUMNS
+        return pd.DataFrame(dict((name, self.get_column(name)) for name in columns),
+                            index=range(self.n_rows), columns=columns)
+
+    def get_column(self, name):
+        """
+        Returns a column: a read-only memory map for numeric
+        columns, a list of unicode strings for text columns
+        """
+        if name in TEXT_COLUMNS:
+            if self.n_rows==0:
+                return []
+            end_offsets = self._memmap(self._fname(name, '.off'), '<i8', self.n_rows)
+            blob = self._memmap(self._fname(name, '.txt'), 'u1', end_offsets[-1])
+            blob = blob.tostring() if len(blob)>0 else ''
+            start = 0
+            texts = []
+            for end in end_offsets.tolist():
+                texts.append(blob[start:end].decode('utf-8'))
+                start = end
+            return texts
+        dtype = dict(NUMERIC_COLUMNS).get(name)
+        if dtype==None:
+            raise KeyError("No column %s in the listing store" % name)
+        return self._memmap(self._fname(name, '.bin'), dtype, self.n_rows)
+
+    def _repair(self):
+        """
+        Truncates the column files to the rows in meta.json
+        (left over from an append that did not finish)
+        """
+        sizes = [(self._fname(name, '.bin'), self.n_rows*np.dtype(dtype).itemsize)
+                 for name, dtype in NUMERIC_COLUMNS]
+        for name in TEXT_COLUMNS:
+            off_fname = self._fname(name, '.off')
+            blob_size = 0
+            if self.n_rows>0:
+                blob_size = int(self._memmap(off_fname, '<i8', self.n_rows)[-1])
+            sizes += [(off_fname, self.n_rows*8), (self._fname(name, '.txt'), blob_size)]
+        for fname, size in sizes:
+            if os.path.exists(fname) and os.path.getsize(fname)>size:
+                out = open(fname, 'r+b')
+                out.truncate(size)
+                out.close()
+
+    def _memmap(self, fname, dtype, n):
+        if n==0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(fname, dtype=dtype, mode='r', shape=(n,))
+
+    def _fname(self, name, ext):
+        return os.path.join(self.path, name + ext)
+
+    def _write_meta(self):
+        meta = {'version': VERSION, 'n_rows': self.n_rows,
+                'numeric': dict(NUMERIC_COLUMNS), 'text': TEXT_COLUMNS}
+        meta_fname = os.path.join(self.path, 'meta.json')
+        out = open(meta_fname + '.tmp', 'w')
+        json.dump(meta, out)
+        out.close()
+        os.rename(meta_fname + '.tmp', meta_fname)
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<3:
+        print "Usage: python listingStore.py store_dir dump1.json [dump2.jsonl ...]"
+        sys.exit(1)
+    import reviewTool
+    store = ListingStore(sys.argv[1])
+    n_new = store.append(reviewTool.load_listings(sys.argv[2:]))
+    print "<> %d listings appended (%d in the store)" % (n_new, len(store))
@@ -11,6 +11,11 @@ import pandas as pd
 import scipy.spatial as sp
 from bs4 import BeautifulSoup
 import reviewTool
+import textStats
+
+# columns of the feature array (see Metric.format_metrics)
+FEATURE_NAMES = ['hasAddress', 'hasPhone', 'hasNbr', 'hasPrice',
+                 'capFraction', 'nWords', 'priceDiff']
 
 class Metric:
     """
@@ -18,11 +23,12 @@ class Metric:
     The Metric object is initiated with a list of dictionaries.
     """
 
-    def __init__(self, listing, coordMat, npriceList):
+    def __init__(self, listing, coordMat, npriceList, coordTree=None):
         """
         Initialize the metric object
 
-        Input:  listing (pd dataframe or json list), coordMat and npriceList (arrays)
+        Input:  listing (pd dataframe or json list), coordMat and npriceList (arrays),
+                coordTree (optional prebuilt spatial index over coordMat)
         """
         if type(listing)!=pd.core.frame.DataFrame:
             self.listing = pd.DataFrame(listing)
@@ -31,90 +37,98 @@ class Metric:
         self.listing    = reviewTool.remove_noPosts(self.listing)
         self.coordMat   = coordMat
         self.npriceList = npriceList
+        if coordTree==None:
+            coordTree = build_coord_tree(coordMat)
+        self.coordTree  = coordTree
 
     def format_metrics(self):
         """
-        Properly calculates and extracts the metric features
+        Properly calculates and extracts the metric features.
+        All the columns are computed with array operations and
+        written into a single preallocated array.
 
         Output: an Nx7 array
         """
-        loc_flag = np.array([1 if lat!=-1 else 0 for lat in self.listing.lat])
-        phn_flag = np.array([1 if phn!=-1 else 0 for phn in self.listing.phone])
-        nbr_flag = np.array([1 if nbr!=-1 else 0 for nbr in self.listing.nbr])
-        prc_flag = np.array([1 if prc!=-1 else 0 for prc in self.listing.price])
-        n_capfrac = self._get_cap_fraction(self.listing)
-        nprice_diff = []
-        for i in range(len(self.listing)):
-            if self.listing.price[i]!=-1 and self.listing.nbr[i]!=-1 and \
-               self.listing.lat[i]!=-1   and self.listing.lon[i]!=-1: 
-                nprice = (self.listing.price[i]/(1.*self.listing.nbr[i]))
-                nprice_diff.append(self._get_perc_diff(
-                                   [self.listing.lon[i], self.listing.lat[i]], 
-                                   nprice))
-            else:
-                nprice_diff.append(0)
-        nprice_diff = np.array(nprice_diff)
-        # make the previous arrays vertical
-        loc_flag = loc_flag.reshape(len(loc_flag), 1)
-        phn_flag = phn_flag.reshape(len(phn_flag), 1)
-        nbr_flag = nbr_flag.reshape(len(nbr_flag), 1)
-        prc_flag = prc_flag.reshape(len(prc_flag), 1)
-        n_capfrac = n_capfrac.reshape(len(n_capfrac), 1)
-        nprice_diff = nprice_diff.reshape(len(nprice_diff), 1)
-        n_words = self._get_n_words(self.listing).reshape(len(self.listing), 1)
-        # concatenate them
-        return np.concatenate((loc_flag, phn_flag, nbr_flag, prc_flag,
-                               n_capfrac, n_words, nprice_diff), axis=1)
+        n = len(self.listing)
+        lat   = np.asarray(self.listing.lat, dtype=float)
+        lon   = np.asarray(self.listing.lon, dtype=float)
+        phone = np.asarray(self.listing.phone, dtype=float)
+        nbr   = np.asarray(self.listing.nbr, dtype=float)
+        price = np.asarray(self.listing.price, dtype=float)
+        feature_arr = np.zeros((n, 7))
+        # flags for the -1 sentinels
+        feature_arr[:, 0] = (lat!=-1)
+        feature_arr[:, 1] = (phone!=-1)
+        feature_arr[:, 2] = (nbr!=-1)
+        feature_arr[:, 3] = (price!=-1)
+        # text statistics (in one pass over the posts)
+        cap_frac, n_words, _ = textStats.get_text_stats(self.listing.post, with_phone=False)
+        feature_arr[:, 4] = cap_frac
+        feature_arr[:, 5] = n_words
+        # price difference w.r. to the neighborhood (0 if no info)
+        wInfo_idx = np.flatnonzero((price!=-1) & (nbr!=-1) & \
+                                   (lat!=-1)   & (lon!=-1))
+        if len(wInfo_idx)>0:
+            loc_arr = np.column_stack((lon[wInfo_idx], lat[wInfo_idx]))
+            feature_arr[wInfo_idx, 6] = self._get_perc_diff(
+                loc_arr, price[wInfo_idx]/nbr[wInfo_idx])
+        return feature_arr
 
     ## Price related methods ##
     def _get_median_nprice(self, loc_arr):
         """
         Calculate the median price based on the nearest 20 apartments
+        (the closest one is skipped). All the locations are looked up 
+        in bulk queries of the spatial index. Equidistant neighbors 
+        are ordered by their index in coordMat.
 
-        Input:  location array (1x2)
-        Output: array of median normalized prices
+        Input:  location array (Nx2)
+        Output: array of median normalized prices (N)
         """
         # the first argument needs a 2d array
-        dist_arr = sp.distance.cdist([loc_arr], self.coordMat)[0]  
-        # use the 20 nearest neighbors
-        top_dist_arr_idx = np.argsort(dist_arr)[1:21] 
-        return np.median(self.npriceList[top_dist_arr_idx])
+        loc_arr = np.atleast_2d(loc_arr)
+        median_nprice = np.empty(len(loc_arr))
+        todo_idx = np.arange(len(loc_arr))
+        # use the 20 nearest neighbors (plus a few to detect ties)
+        k = min(32, len(self.coordMat))
+        while len(todo_idx)>0:
+            dist_arr, top_dist_arr_idx = self.coordTree.query(loc_arr[todo_idx], k=k)
+            dist_arr = dist_arr.reshape(len(todo_idx), k)
+            top_dist_arr_idx = top_dist_arr_idx.reshape(len(todo_idx), k)
+            # the ties are broken by coordMat index
+            order = np.lexsort((top_dist_arr_idx, dist_arr))
+            top_dist_arr_idx = top_dist_arr_idx[np.arange(len(todo_idx))[:, None], order]
+            # all the neighbors tied with the 20th one must have been 
+            # queried, otherwise query more neighbors
+            if k<len(self.coordMat):
+                done = dist_arr[:, min(20, k-1)]<dist_arr[:, k-1]
+            else:
+                done = np.ones(len(todo_idx), dtype=bool)
+            median_nprice[todo_idx[done]] = np.median(
+                self.npriceList[top_dist_arr_idx[done, 1:21]], axis=1)
+            todo_idx = todo_idx[~done]
+            k = min(2*k, len(self.coordMat))
+        return median_nprice
 
     def _get_perc_diff(self, loc_arr, nprice):
         """
         Returns the fractional difference w.r. to the location
         and normalized price
 
-        Input:  location array, norm. price
-        Output: fractional difference (Nx1)
-        """
-        return (nprice - self._get_median_nprice(loc_arr)) \
-               / self._get_median_nprice(loc_arr)
-
-    ## Text related methods ##
-    def _get_cap_fraction(self, listing):
+        Input:  location array (Nx2), norm. price (N)
+        Output: fractional difference (N)
         """
-        Calculates the fraction of capital letters
+        median_nprice = self._get_median_nprice(loc_arr)
+        return (nprice - median_nprice) / median_nprice
 
-        Input:  listing in pd dataframe
-        Output: array of cap fraction
-        """
-        ncapfrac = []  
-        for post in listing.post:
-            n_cap   = len(re.findall('[A-Z]', post))            
-            n_total = len(post) * 1. 
-            ncapfrac.append(n_cap/n_total)
-        return np.array(ncapfrac)
 
-    def _get_n_words(self, listing):
-        """
-        Returns the number of words in the main post text
+def build_coord_tree(coordMat):
+    """
+    Builds the spatial index (KD-tree) over the coordinate matrix.
+    It should be built once and shared by all the Metric objects.
 
-        Input:  listing in pd dataframe
-        Output: array of number of words
-        """
-        n_words = []
-        for post in listing.post:
-            n_words.append(len(post.split()))    
-        return np.array(n_words)
+    Input:  coordMat (Mx2 array)
+    Output: scipy cKDTree
+    """
+    return sp.cKDTree(np.asarray(coordMat, dtype=float))
 
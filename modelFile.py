@@ -0,0 +1,107 @@
+#
+# modelFile.py
+#
+# A compact binary model file: a small versioned header
+# followed by flat arrays that are read back with numpy.memmap
+# (so forked web workers share the same physical pages).
+#
+# Layout:   magic (8 bytes) | version (uint32) | header size (uint32)
+#           | json header | aligned array data (offsets in the header
+#           are relative to the first aligned byte after it) ...
+#
+
+import os
+import sys
+import json
+import struct
+import pickle
+import numpy as np
+
+MAGIC   = 'LSKYMDL\0'
+VERSION = 1
+_ALIGN  = 64
+
+def write_model(fname, arrays, meta=None):
+    """
+    Writes the arrays (and json-able meta data) to the model file.
+    The file is written next to its destination and then renamed,
+    so readers never see a partial model.
+
+    Input:  file name, dictionary of arrays, dictionary of meta data
+    """
+    arrays = dict((name, np.ascontiguousarray(arr)) for name, arr in arrays.items())
+    # offsets are relative to the (aligned) end of the header
+    offset = 0
+    array_info = {}
+    for name in sorted(arrays):
+        array_info[name] = {'dtype':  arrays[name].dtype.str,
+                            'shape':  list(arrays[name].shape),
+                            'offset': offset}
+        offset = _align(offset + arrays[name].nbytes)
+    header = json.dumps({'arrays': array_info, 'meta': meta or {}})
+    data_start = _align(len(MAGIC) + 8 + len(header))
+    tmp_fname = fname + '.tmp'
+    out = open(tmp_fname, 'wb')
+    out.write(MAGIC)
+    out.write(struct.pack('<II', VERSION, len(header)))
+    out.write(header)
+    for name in sorted(arrays):
+        out.write('\0' * (data_start + array_info[name]['offset'] - out.tell()))
+        out.write(arrays[name].tostring())
+    out.close()
+    os.rename(tmp_fname, fname)
+
+def read_model(fname):
+    """
+    Reads the model file. The arrays are read-only memory maps.
+
+    Input:  file name
+    Output: dictionary of arrays, dictionary of meta data
+    """
+    model_file = open(fname, 'rb')
+    magic = model_file.read(len(MAGIC))
+    if magic!=MAGIC:
+        raise ValueError("%s is not a model file" % fname)
+    version, header_size = struct.unpack('<II', model_file.read(8))
+    if version!=VERSION:
+        raise ValueError("Unsupported model file version %d (expected %d)"
+                         % (version, VERSION))
+    header = json.loads(model_file.read(header_size))
+    model_file.close()
+    data_start = _align(len(MAGIC) + 8 + header_size)
+    arrays = {}
+    for name, info in header['arrays'].items():
+        dtype = np.dtype(str(info['dtype']))
+        shape = tuple(info['shape'])
+        if np.prod(shape)==0:
+            arrays[str(name)] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[str(name)] = np.memmap(fname, dtype=dtype, mode='r',
+                                          offset=data_start+info['offset'], shape=shape)
+    return arrays, header['meta']
+
+def convert_pickles(model_fname, coordMat_fname, npriceList_fname, out_fname):
+    """
+    Converts the pickled estimator list, coordMat and npriceList
+    into a single model file
+
+    Input:  pickle file names, output model file name
+    """
+    import bRandomForest
+    ensemble = bRandomForest.BalRandomForest()
+    ensemble.load_model(pickle.load(open(model_fname, 'r')))
+    coordMat   = pickle.load(open(coordMat_fname, 'r'))
+    npriceList = pickle.load(open(npriceList_fname, 'r'))
+    ensemble.export_model(out_fname, coordMat, npriceList)
+
+def _align(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+if __name__ == '__main__':
+    if len(sys.argv)!=5:
+        print "Usage: python modelFile.py ensemble.pickle coordMat.pickle " \
+              "npriceList.pickle out_model.lsm"
+        sys.exit(1)
+    convert_pickles(*sys.argv[1:])
+    print "<> Model written to", sys.argv[4]
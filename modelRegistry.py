@@ -0,0 +1,157 @@
+#
+# modelRegistry.py
+#
+# Hot reload of the model used by the web app. The registry
+# watches a model file (or a directory of model files, the
+# newest one is used), loads a new model in the background
+# and swaps it in at once: a request keeps the model it got
+# when it started, later requests get the new one.
+#
+
+import os
+import sys
+import glob
+import time
+import signal
+import threading
+import traceback
+import metric
+import bRandomForest as brf
+
+class LoadedModel:
+    """
+    Everything a request needs to score listings. It is never
+    modified once published, only replaced.
+    """
+
+    def __init__(self, ensemble, coordMat, npriceList, version):
+        """
+        Input:  BalRandomForest (compiled), coordMat and npriceList
+                (arrays), version of the model (string)
+        """
+        self.ensemble   = ensemble
+        self.coordMat   = coordMat
+        self.npriceList = npriceList
+        self.coordTree  = metric.build_coord_tree(coordMat)
+        self.version    = version
+
+class ModelRegistry:
+    """
+    Holds the current model and reloads it when the model file
+    changes (polling) or on demand (reload, SIGHUP)
+    """
+
+    def __init__(self, path):
+        """
+        Input:  model file (see BalRandomForest.export_model) or
+                directory of model files (*.lsm)
+        """
+        self.path = path
+        self._model = None
+        self._loaded_key = None     # (file name, mtime, size) of the current model
+        self._failed_key = None     # last model file that could not be loaded
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+
+    def current(self):
+        """
+        Returns the current LoadedModel. Requests should call it
+        once and use the returned model throughout.
+        """
+        return self._model
+
+    def publish(self, model):
+        """
+        Swaps in a model loaded elsewhere (e.g. from the pickles)
+        """
+        self._model = model
+
+    def reload(self):
+        """
+        Loads the model file if it changed since the last load and
+        swaps it in. A model file that fails to load is reported
+        and skipped until it changes again; the current model stays.
+
+        Output: whether a new model was swapped in
+        """
+        self._reload_lock.acquire()
+        try:
+            key = self._get_model_key()
+            if key==None or key==self._loaded_key or key==self._failed_key:
+                return False
+            try:
+                model = load_model(key[0])
+            except Exception:
+                self._failed_key = key
+                print >> sys.stderr, "<> Could not load the model %s" % key[0]
+                traceback.print_exc()
+                return False
+            self._model = model
+            self._loaded_key = key
+            print "<> Model %s loaded" % model.version
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def start_watching(self, poll_interval=30., reload_signal=signal.SIGHUP):
+        """
+        Starts a background thread checking the model file every
+        poll_interval seconds, and reloads in the background on
+        reload_signal (only possible from the main thread)
+        """
+        if self._watcher==None:
+            self._watcher = threading.Thread(target=self._watch, args=(poll_interval,))
+            self._watcher.daemon = True
+            self._watcher.start()
+        if reload_signal!=None:
+            try:
+                signal.signal(reload_signal, self._on_signal)
+            except ValueError:
+                pass
+
+    def _watch(self, poll_interval):
+        while True:
+            time.sleep(poll_interval)
+            try:
+                self.reload()
+            except Exception:
+                traceback.print_exc()
+
+    def _on_signal(self, signum, frame):
+        # load in another thread, the handler interrupts the main one
+        reloader = threading.Thread(target=self.reload)
+        reloader.daemon = True
+        reloader.start()
+
+    def _get_model_key(self):
+        """
+        Returns (file name, mtime, size) of the model file to use
+        (the newest one of a directory), None if there is none
+        """
+        if os.path.isdir(self.path):
+            fnames = glob.glob(os.path.join(self.path, '*.lsm'))
+        else:
+            fnames = [self.path]
+        keys = []
+        for fname in fnames:
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+            keys.append((fname, stat.st_mtime, stat.st_size))
+        if len(keys)==0:
+            return None
+        return max(keys, key=lambda key: (key[1], key[0]))
+
+
+def load_model(fname):
+    """
+    Loads a model file into a LoadedModel (the version is the
+    file name and its modification time)
+    """
+    ensemble = brf.BalRandomForest()
+    coordMat, npriceList = ensemble.load_model_file(fname)
+    version = '%s@%s' % (os.path.basename(fname),
+                         time.strftime('%Y%m%d-%H%M%S',
+                                       time.localtime(os.path.getmtime(fname))))
+    return LoadedModel(ensemble, coordMat, npriceList, version)
@@ -0,0 +1,250 @@
+#
+# pageParser.py
+#
+# Targeted extraction of the craigslist fields we use (rows of
+# the index pages, posting body and removal notice of the post
+# pages) in one streaming pass of HTMLParser, without building
+# a BeautifulSoup tree of the whole page.
+#
+
+import re
+import htmlentitydefs
+from HTMLParser import HTMLParser, HTMLParseError
+
+_nbr_re = re.compile(r' / [0-9]br - ')
+_prc_re = re.compile(r'\$\d+')
+_nbr_clean_re = re.compile(r'[ /a-z-]*')
+
+_ASCII_SPACES = u'\x20\x0a\x09\x0c\x0d'
+_VOID_TAGS = set(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                  'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+
+def parse_index(page):
+    """
+    Extracts the listing rows (p.row) of an index or search page
+
+    Input:  page content (string)
+    Output: list of dictionaries with pid, head, lon, lat, nbr,
+            price (-1 if missing) and href (relative link)
+    """
+    parser = _IndexParser()
+    _feed(parser, page)
+    rows = []
+    for attrs, strings, anchors in parser.rows:
+        text = u''.join(strings)
+        row = {}
+        row['pid'] = int(attrs.get('data-pid'))
+        if 'data-longitude' in attrs and 'data-latitude' in attrs:
+            row['lon'] = float(attrs['data-longitude'])
+            row['lat'] = float(attrs['data-latitude'])
+        else:
+            row['lon'] = -1
+            row['lat'] = -1
+        row['href'] = anchors[0][0] if len(anchors)>0 else None
+        row['head'] = _get_string(anchors[1][1]) if len(anchors)>1 else None
+        nbr_match = _nbr_re.search(text)
+        if nbr_match!=None:
+            row['nbr'] = int(_nbr_clean_re.sub('', nbr_match.group()))
+        else:
+            row['nbr'] = -1
+        prc_match = _prc_re.search(text)
+        if prc_match!=None:
+            row['price'] = float(prc_match.group()[1:])
+        else:
+            row['price'] = -1
+        rows.append(row)
+    return rows
+
+def parse_post(page):
+    """
+    Extracts the posting body and the removal notice of a post page
+
+    Input:  page content (string)
+    Output: dictionary with 'body' (the strings of section#postingbody
+            joined by spaces, None if there is none) and 'removed'
+            (text of the first div.removed, None if there is none)
+    """
+    parser = _PostParser()
+    _feed(parser, page)
+    body = None
+    if parser.body_strings!=None:
+        body = u' '.join(parser.body_strings)
+    removed = None
+    if parser.removed_strings!=None:
+        removed = u''.join(parser.removed_strings)
+    return {'body': body, 'removed': removed}
+
+
+class _TextParser(HTMLParser):
+    """
+    Collects the character data between tags into strings,
+    the way BeautifulSoup makes its NavigableStrings
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self._data = []
+
+    def handle_data(self, data):
+        self._data.append(data)
+
+    def handle_entityref(self, name):
+        codepoint = htmlentitydefs.name2codepoint.get(name)
+        if codepoint!=None:
+            self._data.append(unichr(codepoint))
+        else:
+            self._data.append(u'&' + name)
+
+    def handle_charref(self, name):
+        try:
+            if name[0] in 'xX':
+                codepoint = int(name[1:], 16)
+            else:
+                codepoint = int(name)
+            if 128<=codepoint<=159:
+                char = chr(codepoint).decode('cp1252')
+            else:
+                char = unichr(codepoint)
+        except (ValueError, OverflowError, UnicodeDecodeError):
+            char = u'\ufffd'
+        self._data.append(char)
+
+    def handle_comment(self, data):
+        self._flush()
+        self.handle_string(data)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in _VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def _flush(self):
+        if len(self._data)==0:
+            return
+        text = u''.join(self._data)
+        self._data = []
+        if len(text.strip(_ASCII_SPACES))==0:
+            text = u'\n' if u'\n' in text else u' '
+        self.handle_string(text)
+
+    def handle_string(self, text):
+        pass
+
+
+class _IndexParser(_TextParser):
+    """
+    Keeps the attributes, the text and the anchors (href and
+    content) of each p.row
+    """
+
+    def __init__(self):
+        _TextParser.__init__(self)
+        self.rows = []
+        self._row = None
+        self._anchor = None     # stack of the open nodes of the current anchor
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        if tag=='p' and 'row' in (dict(attrs).get('class') or '').split():
+            self._row = (dict(attrs), [], [])
+            self.rows.append(self._row)
+            self._anchor = None
+            return
+        if self._row==None:
+            return
+        if self._anchor!=None:
+            node = []
+            self._anchor[-1].append(node)
+            if tag not in _VOID_TAGS:
+                self._anchor.append(node)
+        elif tag=='a':
+            content = []
+            self._row[2].append((dict(attrs).get('href'), content))
+            self._anchor = [content]
+
+    def handle_endtag(self, tag):
+        self._flush()
+        if self._row==None:
+            return
+        if self._anchor!=None and tag not in _VOID_TAGS:
+            self._anchor.pop()
+            if len(self._anchor)==0:
+                self._anchor = None
+        elif tag=='p':
+            self._row = None
+
+    def handle_string(self, text):
+        if self._row==None:
+            return
+        self._row[1].append(text)
+        if self._anchor!=None:
+            self._anchor[-1].append(text)
+
+
+class _PostParser(_TextParser):
+    """
+    Keeps the strings of the first section#postingbody and of
+    the first div.removed
+    """
+
+    def __init__(self):
+        _TextParser.__init__(self)
+        self.body_strings = None
+        self.removed_strings = None
+        self._body_depth = 0
+        self._removed_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        if tag=='section':
+            if self._body_depth>0:
+                self._body_depth += 1
+            elif self.body_strings==None and dict(attrs).get('id')=='postingbody':
+                self.body_strings = []
+                self._body_depth = 1
+        elif tag=='div':
+            if self._removed_depth>0:
+                self._removed_depth += 1
+            elif self.removed_strings==None and \
+                 'removed' in (dict(attrs).get('class') or '').split():
+                self.removed_strings = []
+                self._removed_depth = 1
+
+    def handle_endtag(self, tag):
+        self._flush()
+        if tag=='section' and self._body_depth>0:
+            self._body_depth -= 1
+        elif tag=='div' and self._removed_depth>0:
+            self._removed_depth -= 1
+
+    def handle_string(self, text):
+        if self._body_depth>0:
+            self.body_strings.append(text)
+        if self._removed_depth>0:
+            self.removed_strings.append(text)
+
+
+def _feed(parser, page):
+    if not isinstance(page, unicode):
+        try:
+            page = page.decode('utf-8')
+        except UnicodeDecodeError:
+            page = page.decode('cp1252', 'replace')
+    try:
+        parser.feed(page)
+        parser.close()
+    except HTMLParseError:
+        # keep what was extracted before the malformed markup
+        pass
+    parser._flush()
+
+def _get_string(content):
+    """
+    BeautifulSoup's .string of a node: its only string, looking
+    through tags with a single child (None otherwise)
+    """
+    while len(content)==1:
+        if not isinstance(content[0], list):
+            return content[0]
+        content = content[0]
+    return None
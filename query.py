@@ -5,64 +5,74 @@
 #   processing of craigslist data
 #
 
-import urllib2
 import re
+import time
 import numpy as np
 import pandas as pd
 import scipy.spatial as sp
-from bs4 import BeautifulSoup
 from sklearn.ensemble import RandomForestClassifier as rfc
+import fetchTool
+import pageParser
+import textStats
 
 class Query:
     """
     Query object to scrape and return a dictionary of posts
     """
     
-    def __init__(self, query_terms):
+    def __init__(self, query_terms, cache=None):
+        """
+        Input:  list of query terms, fetchTool.PageCache for the
+                post pages (optional)
+        """
         self.query_terms = query_terms 
+        self.cache = cache
+        # time spent fetching and parsing by the last scrape (seconds)
+        self.stage_times = {'fetch': 0., 'parse': 0.}
         self.url_root = 'http://sfbay.craigslist.org'
         self.url = 'http://sfbay.craigslist.org/search/apa?zoomToPosting=&query=' 
 
-    def scrape(self, n_post=10):
+    def scrape(self, n_post=10, n_workers=1, timeout=10):
         """
         Scrape away!
         Scrapes n_post posts and returns all the relevant information
         as a list of dictionaries
 
-        Input:  number of posts to scrape (real-time)
+        Input:  number of posts to scrape (real-time), number of
+                concurrent post fetches, timeout of each fetch (seconds)
         Output: list of dictionaries
         """
         post_collection = []
+        self.stage_times = {'fetch': 0., 'parse': 0.}
         for q in self.query_terms:
             self.url = self.url + q + '+'
         self.url = self.url[:-1]
-        page = urllib2.urlopen(self.url)
-        soup = BeautifulSoup(page)
-        listing = soup.find_all('p', attrs={'class':'row'})
+        start = time.time()
+        page = fetchTool.fetch_page(self.url, timeout)
+        start = self._add_stage_time('fetch', start)
+        listing = pageParser.parse_index(page)
         if len(listing)==0:
+            self._add_stage_time('parse', start)
             return None
-        for post in listing[:n_post]:
-            nbr_match = re.search(' / [0-9]br - ', str(post))
-            prc_match = re.search('\$\d+', str(post))
-            head = post.find_all('a')[1].string
-            pid = int(post.get('data-pid'))
-            lon, lat = self._check_loc(post)      # Check for presence of location
-            nbr = self._check_nbr(nbr_match)      # Check for presence of # of rooms
-            price = self._check_prc(prc_match)    # Check for presence of price
-            ### Posting main text body ###
-            post_link = self.url_root + str(post.a['href'])
-            page = urllib2.urlopen(post_link)
-            post_soup = BeautifulSoup(page)
+        post_info = []
+        for row in listing[:n_post]:
+            post_link = self.url_root + str(row['href'])
+            post_info.append((row['pid'], row['head'], row['lon'], row['lat'],
+                              row['nbr'], row['price'], post_link))
+        start = self._add_stage_time('parse', start)
+        ### Posting main text body (fetched concurrently) ###
+        post_pages = fetchTool.iter_pages([info[-1] for info in post_info],
+                                          n_workers, timeout, cache=self.cache)
+        for (pid, head, lon, lat, nbr, price, post_link) in post_info:
+            page = post_pages.next()
+            start = self._add_stage_time('fetch', start)
+            post_page = pageParser.parse_post(page)
+            start = self._add_stage_time('parse', start)
             # Check for 'removed tag'
-            if len(post_soup.find_all('div', attrs={'class':'removed'}))==0:
-                post_text = post_soup.find_all('section', attrs={'id':'postingbody'})
-                if len(post_text)>0:
-                    post_text_clean = self._clean_text(post_text[0])
-                    phone_match = re.findall(r'\d{3}\W*\d{3}\W*\d{4}', post_text_clean)
-                    if len(phone_match)>0:
-                        phone = int(re.sub(r'\W', '', phone_match[0]))
-                    else:
-                        phone = -1
+            if post_page['removed']==None:
+                if post_page['body']!=None:
+                    post_text_clean = self._clean_text(post_page['body'])
+                    phone = textStats.get_phone_number(post_text_clean)
                 else:
                     post_text_clean = ' ' 
                     phone = -1
@@ -85,48 +95,21 @@ class Query:
                 continue
         return post_collection
 
+    def _add_stage_time(self, stage, start):
+        """
+        Adds the time since start to the stage and returns 
+        the current time
+        """
+        now = time.time()
+        self.stage_times[stage] += now - start
+        return now
+
     def _clean_text(self, text):
         """
         Removes all unwanted and unnecessary symbols
         """
-        post_text_clean = ' '.join(text.findAll(text=True))
-        #post_text_clean = re.sub('<.*>', '', repr(text))
-        post_text_clean = re.sub('\n|\t', ' ', post_text_clean)
+        post_text_clean = re.sub('\n|\t', ' ', text)
         post_text_clean = re.sub(' +', ' ', post_text_clean)
         post_text_clean = re.sub("'", '', post_text_clean)
         post_text_clean = re.sub('"', '', post_text_clean)
         return post_text_clean
-
-    def _check_loc(self, post):
-        """
-        Check for location presence
-        """
-        if post.has_attr('data-longitude') and \
-           post.has_attr('data-latitude'):
-            lon = float(post.get('data-longitude'))
-            lat = float(post.get('data-latitude'))
-        else:
-            lon = -1
-            lat = -1
-        return lon, lat
-
-    def _check_nbr(self, nbr_match):
-        """
-        Check for nbr info presence
-        """
-        if nbr_match!=None:
-            nbr = int(re.sub('[ /a-z-]*', '', nbr_match.group()))
-        else:
-            nbr = -1
-        return nbr
-
-    def _check_prc(self, prc_match):
-        """
-        Check for price info presence
-        """
-        if prc_match!=None:
-            price_str = prc_match.group()
-            price = float(re.sub('\$', '', str(prc_match.group())))
-        else:
-            price = -1
-        return price
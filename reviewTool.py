@@ -8,25 +8,31 @@
 
 import os 
 import json
-import urllib2
-import bs4
+import codecs
+import itertools
 import re
 import numpy as np
 import pandas as pd
+import fetchTool
+import pageParser
+import textStats
 
-def separate_posts(path):
+def separate_posts(path, n_workers=1, checkpoint_fname=None, cache=None):
     """
     This function encapsulates the entire post reviewing
     processes: scraping (2nd run), duplicate removal,
     and the actual reviewing to split posts between 
     legit and scams.
 
-    Input:  path to the json files of 1st run scrapes
+    Input:  path to the json files of 1st run scrapes,
+            number of concurrent fetches, review checkpoint file,
+            fetchTool.PageCache (optional)
     Output: legit and scams list of dictionaries
     """
     listing_json = get_scrapped_list(path)
     listing_df = remove_duplicates(listing_json)
-    legit, scams = review_listing(listing_df)
+    legit, scams = review_listing(listing_df, n_workers, checkpoint_fname, 
+                                  cache=cache)
     legit = reprocess_phoneNumber_flag(legit)
     scams = reprocess_phoneNumber_flag(scams)
     return legit, scams
@@ -39,10 +45,7 @@ def remove_duplicates(list_of_json):
     Input:  list of dictionaries
     Output: pandas data frame
     """
-    listing_df = pd.DataFrame()
-    for json_entry in list_of_json:
-        json_buffer = pd.DataFrame(json_entry)
-        listing_df = pd.concat((listing_df, json_buffer))
+    listing_df = pd.concat([pd.DataFrame(json_entry) for json_entry in list_of_json])
     listing_df.index = range(len(listing_df))
     listing_df = listing_df.drop_duplicates(cols='pid')
     listing_df.index = range(len(listing_df))
@@ -69,6 +72,77 @@ def patch_listings(json_fname_list):
             patched_list.append(post)
     return patched_list
 
+def load_listings(fname_list):
+    """
+    Streams the json dumps (or JSON Lines crawls) and builds the
+    cleaned up listing dataframe in a single pass: duplicated pids
+    are dropped on the fly (the first occurrence is kept), the posts
+    without text are left out and the phone numbers are reprocessed.
+    This is the same as patch_listings + remove_duplicates +
+    remove_noPosts + reprocess_phoneNumber_flag, but only the unique
+    rows are kept in memory.
+
+    Input:  list of json file names
+    Output: pandas dataframe
+    """
+    seen_pids = set()
+    columns = {}
+    n_rows = 0
+    for fname in fname_list:
+        for post in iter_listing_file(fname):
+            if post['pid'] in seen_pids:
+                continue
+            seen_pids.add(post['pid'])
+            if post.get('hasPost')!=1:
+                continue
+            post['phone'] = textStats.get_phone_number(post['post'])
+            for key, value in post.items():
+                if key not in columns:
+                    columns[key] = [None] * n_rows
+                columns[key].append(value)
+            n_rows += 1
+            for key in columns:
+                if len(columns[key])<n_rows:
+                    columns[key].append(None)
+    return pd.DataFrame(columns, index=range(n_rows))
+
+def iter_listing_file(fname, chunk_size=1<<16):
+    """
+    Yields the listing dictionaries of a json dump (a list of
+    dictionaries) or of a JSON Lines file one at a time, reading
+    the file in chunks instead of loading it in full
+
+    Input:  file name, size of the chunks read (bytes)
+    Output: generator of dictionaries
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    in_file = open(fname, 'rb')
+    buf = u''
+    pos = 0
+    eof = False
+    try:
+        while True:
+            # skip the separators between the dictionaries
+            while pos<len(buf) and buf[pos] in u' \t\r\n,[]':
+                pos += 1
+            if pos<len(buf):
+                try:
+                    post, pos = decoder.raw_decode(buf, pos)
+                    yield post
+                    continue
+                except ValueError:
+                    if eof:
+                        raise
+            elif eof:
+                break
+            chunk = in_file.read(chunk_size)
+            eof = (len(chunk)==0)
+            buf = buf[pos:] + utf8.decode(chunk, final=eof)
+            pos = 0
+    finally:
+        in_file.close()
+
 def get_scrapped_list(path):
     """
     Gets the sorted (latest files first) list of 
@@ -95,43 +169,89 @@ def clean_post_text(text):
     clean_text = re.sub('\n|\t', ' ', listing_text_clean)
     return clean_text
 
-def review_listing(list_df):
+def review_listing(list_df, n_workers=1, checkpoint_fname=None, timeout=10,
+                   cache=None):
     """
     Review each of the listing to check whether it has
-    been removed or not.
+    been removed or not. The links are fetched concurrently and, 
+    if a checkpoint file is given, each pid's verdict is appended
+    to it as soon as it is known. An interrupted review restarts
+    from the checkpoint: those pids are never fetched again.
+    Since the removal status changes, the page cache should 
+    have a short ttl (0 always revalidates).
 
-    Input:  a pandas dataframe of the listing 
+    Input:  a pandas dataframe of the listing, number of concurrent
+            fetches, checkpoint file name (optional), fetch timeout,
+            fetchTool.PageCache (optional)
     Output: legit and scams list of dictionaries
     """
-    n = 0
     listing_dict = get_listing_dict(list_df)
-    listing_scams = []
-    listing_legit = []
+    listing_pids  = np.array(list_df['pid'])
     listing_links = np.array(list_df['link'])
-    for idx in range(len(listing_links)):
-        print "%d / %d" %(n, len(listing_links)), listing_links[idx]
+    verdicts = {}
+    if checkpoint_fname!=None:
+        verdicts = load_review_checkpoint(checkpoint_fname)
+        checkpoint = open(checkpoint_fname, 'a')
+    todo_idx = [idx for idx in range(len(listing_links))
+                if listing_pids[idx] not in verdicts]
+    print "%d / %d already reviewed" % (len(listing_links)-len(todo_idx), 
+                                        len(listing_links))
+    pages = fetchTool.iter_pages([listing_links[idx] for idx in todo_idx],
+                                 n_workers, timeout, skip_errors=True,
+                                 cache=cache)
+    n = 0
+    for idx, page in itertools.izip(todo_idx, pages):
+        print "%d / %d" %(n, len(todo_idx)), listing_links[idx]
         n += 1
-        try:
-            page = urllib2.urlopen(listing_links[idx])
-        except:
+        if page==None:
             print "  ----> Bad link (skip it!)"
             continue
-        post_soup = bs4.BeautifulSoup(page)
-        post_text = post_soup.find_all('section', attrs={'id':'postingbody'})
-        post_dict = {} 
-        if len(post_soup.find_all('div', attrs={'class':'removed'}))>0:
-            removal_clause = str(
-                post_soup.find_all('div', attrs={'class':'removed'})[0]
-            )
-            match = re.search('flagged for removal', removal_clause)
-            if match:
-                listing_scams.append(listing_dict[idx])
-            else:
-                listing_legit.append(listing_dict[idx])
-        else:
+        verdict = _get_review_verdict(page)
+        verdicts[listing_pids[idx]] = verdict
+        if checkpoint_fname!=None:
+            checkpoint.write("%d\t%s\n" % (listing_pids[idx], verdict))
+            checkpoint.flush()
+    if checkpoint_fname!=None:
+        checkpoint.close()
+    listing_scams = []
+    listing_legit = []
+    for idx in range(len(listing_links)):
+        verdict = verdicts.get(listing_pids[idx])
+        if verdict=='scams':
+            listing_scams.append(listing_dict[idx])
+        elif verdict=='legit':
             listing_legit.append(listing_dict[idx])
     return listing_legit, listing_scams 
 
+def load_review_checkpoint(checkpoint_fname):
+    """
+    Reads the verdicts of a review checkpoint file (one 'pid verdict'
+    line per reviewed post). A missing file is an empty checkpoint.
+
+    Input:  checkpoint file name
+    Output: dictionary of pid -> 'legit' or 'scams'
+    """
+    verdicts = {}
+    if not os.path.exists(checkpoint_fname):
+        return verdicts
+    for line in open(checkpoint_fname, 'r'):
+        fields = line.split()
+        # a partly written last line is ignored
+        if len(fields)==2 and fields[1] in ('legit', 'scams') and \
+           line.endswith('\n'):
+            verdicts[int(fields[0])] = fields[1]
+    return verdicts
+
+def _get_review_verdict(page):
+    """
+    Returns 'scams' if the post page has been flagged 
+    for removal, 'legit' otherwise
+    """
+    removal_clause = pageParser.parse_post(page)['removed']
+    if removal_clause!=None and 'flagged for removal' in removal_clause:
+        return 'scams'
+    return 'legit'
+
 def reprocess_phoneNumber_flag(list_df):
     """
     This method corrects the bug in misidentifying phone 
@@ -140,14 +260,7 @@ def reprocess_phoneNumber_flag(list_df):
     Input:  panda dataframe
     Output: panda dataframe
     """
-    for i in range(len(list_df)):
-        phone_match = re.findall('\d{3}\W*\d{3}\W*\d{4}', list_df.post[i])
-        phone = 0
-        if len(phone_match)>0:
-            phone = int(re.sub(r'\W', '', phone_match[0]))
-        else:
-            phone = -1
-        list_df.phone[i] = phone
+    list_df['phone'] = textStats.get_phone_numbers(list_df.post)
     return list_df
 
 def get_nprice_and_coordMat(legit_df):
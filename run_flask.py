@@ -1,10 +1,24 @@
 from flask import Flask
 from flask import request
 from flask import render_template
+from flask import jsonify
+from flask import g
+from flask import Response
 
+import os
+import math
 import socket
 import json
+import time
+import itertools
+import threading
 import query
+import reviewTool
+import textStats
+import fetchTool
+import scoreCache
+import modelRegistry
+import serverMetrics
 import metric
 import frontFormating as ff
 import bRandomForest as brf
@@ -12,18 +26,111 @@ import pickle
 import numpy as np
 
 app = Flask(__name__)
+# Largest batch of listings accepted by /api/score
+app.config['SCORE_BATCH_LIMIT'] = int(os.environ.get('SCORE_BATCH_LIMIT', 5000))
+# Largest request body (bytes), refused before it is read or decoded
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('SCORE_MAX_BYTES', 64*1024*1024))
+# The search results only show labels: stop evaluating the trees once
+# the label of a post is known (see FlatForest.predict_early_exit)
+app.config['EARLY_EXIT'] = os.environ.get('LESSSKETCHY_EARLY_EXIT', '1')!='0'
 
-# Load the ensemble models
-#clf_model  = pickle.load(open('./pickle_jar/ensembleModel_scan11_v1.pickle', 'r'))
-clf_model  = pickle.load(open('/home/ubuntu/LessSketchy/pickle_jar/ensembleModel_scan12_v1.pickle', 'r'))
-print "<> Training model loaded"
+# Load the ensemble model, coordMat and npriceList info. From a model
+# file (or a directory of model files, the newest is used) the model is
+# hot reloaded: the file is checked every LESSSKETCHY_MODEL_POLL seconds
+# and on SIGHUP (see modelRegistry.py). Otherwise it is loaded once from 
+# the pickles; a directory is still watched, so that its first model
+# file replaces the pickles.
+model_fpath = os.environ.get('LESSSKETCHY_MODEL', 
+                             '/home/ubuntu/LessSketchy/pickle_jar/ensembleModel_scan12_v1.lsm')
+model_registry = modelRegistry.ModelRegistry(model_fpath)
+model_loaded = model_registry.reload()
+if model_loaded or os.path.isdir(model_fpath):
+    model_registry.start_watching(float(os.environ.get('LESSSKETCHY_MODEL_POLL', 30)))
+if model_loaded:
+    print "<> Training model, coord and normalized data loaded"
+else:
+    ensemble   = brf.BalRandomForest()
+    #clf_model  = pickle.load(open('./pickle_jar/ensembleModel_scan11_v1.pickle', 'r'))
+    clf_model  = pickle.load(open('/home/ubuntu/LessSketchy/pickle_jar/ensembleModel_scan12_v1.pickle', 'r'))
+    ensemble.load_model(clf_model)
+    ensemble.compile_model()
+    print "<> Training model loaded"
+
+    # Load coordMat and npriceList info
+    #coordMat   = pickle.load(open('./pickle_jar/coordMat_scan11_v1.pickle', 'r'))
+    #npriceList = pickle.load(open('./pickle_jar/npriceList_scan11_v1.pickle', 'r'))
+    coordMat   = pickle.load(open('/home/ubuntu/LessSketchy/pickle_jar/coordMat_scan12_v1.pickle', 'r'))
+    npriceList = pickle.load(open('/home/ubuntu/LessSketchy//pickle_jar/npriceList_scan12_v1.pickle', 'r'))
+    print "<> coord and normalized data loaded"
+    model_registry.publish(modelRegistry.LoadedModel(ensemble, coordMat, npriceList,
+                                                     'ensembleModel_scan12_v1.pickle'))
+
+# Post pages shared between requests (and with the scraping tools)
+page_cache = fetchTool.PageCache('./page_cache', ttl=15*60)
+# Scored listings (features, score, label and hint) by pid
+score_cache = scoreCache.ScoreCache(max_size=10000, ttl=60*60)
+# Scored examples of the test samples (see get_examples)
+example_fpaths = ['./test_sample/hist_cl_legit_20130625-1650.json',
+                  './test_sample/hist_cl_scams_20130625-1650.json']
+example_rows   = {'key': None, 'rows': None}
+example_lock   = threading.Lock()
+
+# Request counters, latency histograms and cache statistics (see /metrics)
+registry = serverMetrics.Registry()
+request_count = registry.counter('lesssketchy_requests_total',
+                                 'HTTP requests by endpoint and status',
+                                 ('endpoint', 'status'))
+error_count = registry.counter('lesssketchy_request_errors_total',
+                               'Requests that raised an exception',
+                               ('endpoint',))
+request_latency = registry.histogram('lesssketchy_request_seconds',
+                                     'Request latency (seconds)', ('endpoint',))
+stage_latency = registry.histogram('lesssketchy_stage_seconds',
+                                   'Latency of the stages of a request (seconds): '
+                                   'fetch, parse, features, inference, render',
+                                   ('endpoint', 'stage'))
+registry.gauge('lesssketchy_score_cache_hits_total', 'Score cache hits',
+               lambda: score_cache.hits, 'counter')
+registry.gauge('lesssketchy_score_cache_misses_total', 'Score cache misses',
+               lambda: score_cache.misses, 'counter')
+registry.gauge('lesssketchy_score_cache_hit_ratio', 'Score cache hit ratio',
+               lambda: serverMetrics.get_ratio(score_cache.hits,
+                                               score_cache.hits+score_cache.misses))
+registry.gauge('lesssketchy_score_cache_size', 'Listings in the score cache',
+               lambda: len(score_cache))
+registry.gauge('lesssketchy_page_cache_hits_total', 'Fresh pages served by the page cache',
+               lambda: page_cache.hits, 'counter')
+registry.gauge('lesssketchy_page_cache_revalidations_total', 
+               'Cached pages revalidated (304) by craigslist',
+               lambda: page_cache.revalidations, 'counter')
+registry.gauge('lesssketchy_page_cache_misses_total', 'Pages fetched in full',
+               lambda: page_cache.misses, 'counter')
+registry.gauge('lesssketchy_page_cache_hit_ratio', 
+               'Page cache hit ratio (fresh or revalidated pages)',
+               lambda: serverMetrics.get_ratio(page_cache.hits+page_cache.revalidations,
+                                               page_cache.hits+page_cache.revalidations+
+                                               page_cache.misses))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
 
-# Load coordMat and npriceList info
-#coordMat   = pickle.load(open('./pickle_jar/coordMat_scan11_v1.pickle', 'r'))
-#npriceList = pickle.load(open('./pickle_jar/npriceList_scan11_v1.pickle', 'r'))
-coordMat   = pickle.load(open('/home/ubuntu/LessSketchy/pickle_jar/coordMat_scan12_v1.pickle', 'r'))
-npriceList = pickle.load(open('/home/ubuntu/LessSketchy//pickle_jar/npriceList_scan12_v1.pickle', 'r'))
-print "<> coord and normalized data loaded"
+@app.after_request
+def count_request(response):
+    endpoint = request.endpoint or 'none'
+    request_count.inc((endpoint, str(response.status_code)))
+    if hasattr(g, 'request_start'):
+        request_latency.observe(time.time() - g.request_start, (endpoint,))
+    return response
+
+@app.teardown_request
+def count_error(exc):
+    if exc!=None:
+        error_count.inc((request.endpoint or 'none',))
+
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
@@ -36,84 +143,199 @@ def search_results():
     search_terms = search_terms.lower()
     search_terms = search_terms.split()
 
+    # the model of this request (even if a new one is swapped in meanwhile)
+    model = model_registry.current()
+
     # Scrape and process listing
-    q = query.Query(search_terms)
-    post_listing  = q.scrape(5)
+    q = query.Query(search_terms, page_cache)
+    post_listing  = q.scrape(5, n_workers=5)
+    for stage in ('fetch', 'parse'):
+        stage_latency.observe(q.stage_times[stage], ('search_results', stage))
     if post_listing==None:
-        return render_template('no-result.html')
-    # Get the feature array
-    m = metric.Metric(post_listing, coordMat, npriceList)
-    feature_arr = m.format_metrics()
-    # Setup the classifier
-    ensemble = brf.BalRandomForest()
-    ensemble.load_model(clf_model)
-    post_score = ensemble.predict(feature_arr) 
+        with stage_latency.time(('search_results', 'render')):
+            return render_template('no-result.html')
+    # Score the posts that are not cached yet
+    post_scored = [score_cache.get(post['pid'], model.version) for post in post_listing]
+    new_idx = [p for p in range(len(post_listing)) if post_scored[p]==None]
+    if len(new_idx)>0:
+        # Get the feature array
+        with stage_latency.time(('search_results', 'features')):
+            m = metric.Metric([post_listing[p] for p in new_idx], 
+                              model.coordMat, model.npriceList, model.coordTree)
+            feature_arr = m.format_metrics()
+        with stage_latency.time(('search_results', 'inference')):
+            if app.config['EARLY_EXIT']:
+                post_score = model.ensemble.predict_early_exit(
+                    feature_arr, (ff.LEGIT_THRESHOLD, ff.SKETCHY_THRESHOLD))[0]
+            else:
+                post_score = model.ensemble.predict(feature_arr)
+        for i, p in enumerate(new_idx):
+            label, message = ff.get_sketchyLevel(post_score[i])
+            post_scored[p] = {'features': feature_arr[i],
+                              'score':    post_score[i],
+                              'label':    label,
+                              'message':  message,
+                              'hint':     ff.get_hint(feature_arr[i])}
+            score_cache.put(post_listing[p]['pid'], post_scored[p], model.version)
 
     post_links = []
     for p in range(len(post_listing)):
         modal_label = "ModalPost" + str(p)
-        label, message = ff.get_sketchyLevel(post_score[p])
-        hint_str = ff.get_hint(feature_arr[p])
         post_links.append((post_listing[p]['head'], 
                            post_listing[p]['link'],
-                           label, 
-                           message,
-                           hint_str,
+                           post_scored[p]['label'], 
+                           post_scored[p]['message'],
+                           post_scored[p]['hint'],
                            modal_label,
                            post_listing[p]['post']))
 
-    return render_template('search-results.html', post_links=post_links)
+    with stage_latency.time(('search_results', 'render')):
+        return render_template('search-results.html', post_links=post_links)
+
+@app.route('/api/score', methods=['POST'])
+def api_score():
+    """
+    Scores a batch of listings posted as JSON, {"listings": [...]},
+    each listing with the fields of the scraped dictionaries (pid, 
+    lat, lon, price, nbr, post and optionally phone). The whole batch 
+    goes through one Metric and one predict call.
+    Listings without post text, or with invalid values (see
+    _get_listing_error), are returned with an error instead of a score.
+    """
+    try:
+        listing_json = json.loads(request.data)['listings']
+        if type(listing_json)!=list:
+            raise ValueError("listings is not a list")
+        if len(listing_json)>app.config['SCORE_BATCH_LIMIT']:
+            return jsonify({'error': 'Too many listings (at most %d per request)'
+                                     % app.config['SCORE_BATCH_LIMIT']}), 413
+        listings = [_parse_api_listing(post) for post in listing_json]
+    except (ValueError, KeyError, TypeError, AttributeError, OverflowError), e:
+        return jsonify({'error': 'Bad request (%s: %s)' % (e.__class__.__name__, e)}), 400
+    model = model_registry.current()
+    errors = [_get_listing_error(post) for post in listings]
+    wPost_idx = [p for p in range(len(listings)) if errors[p]==None]
+    results = [{'pid': listings[p]['pid'], 'error': errors[p]} for p in range(len(listings))]
+    if len(wPost_idx)>0:
+        with stage_latency.time(('api_score', 'features')):
+            m = metric.Metric([listings[p] for p in wPost_idx], 
+                              model.coordMat, model.npriceList, model.coordTree)
+            feature_arr = m.format_metrics()
+        with stage_latency.time(('api_score', 'inference')):
+            post_score  = model.ensemble.predict(feature_arr)
+        for i, p in enumerate(wPost_idx):
+            label, message = ff.get_sketchyLevel(post_score[i])
+            results[p] = {'pid':      listings[p]['pid'],
+                          'score':    float(post_score[i]),
+                          'label':    message,
+                          'features': dict(zip(metric.FEATURE_NAMES, 
+                                               feature_arr[i].tolist())),
+                          'hint':     ff.get_hint(feature_arr[i])}
+    return jsonify({'results': results})
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': 'Request body too large (at most %d bytes)'
+                             % app.config['MAX_CONTENT_LENGTH']}), 413
+
+def _parse_api_listing(post):
+    """
+    Checks and converts a listing posted to /api/score
+    (the phone number is looked up in the post if not given)
+    """
+    listing = {'pid':   int(post['pid']),
+               'lat':   float(post.get('lat', -1)),
+               'lon':   float(post.get('lon', -1)),
+               'price': float(post.get('price', -1)),
+               'nbr':   int(post.get('nbr', -1)),
+               'post':  post.get('post') or u''}
+    if not isinstance(listing['post'], basestring):
+        raise ValueError("post of %d is not a string" % listing['pid'])
+    if post.get('phone')!=None:
+        listing['phone'] = int(post['phone'])
+    else:
+        listing['phone'] = textStats.get_phone_number(listing['post'])
+    listing['hasPost'] = 1 if len(listing['post'].split())>0 else 0
+    return listing
+
+def _get_listing_error(listing):
+    """
+    Returns why a converted listing cannot be scored (None if
+    it can): no post text, a location or price that is not a
+    finite number (or a price too large for the price ratio),
+    or a number of bedrooms neither -1 nor positive
+    """
+    if listing['hasPost']!=1:
+        return 'No post text'
+    for name in ('lat', 'lon', 'price'):
+        if math.isinf(listing[name]) or math.isnan(listing[name]):
+            return 'Invalid %s' % name
+    if listing['price']>=1e9:
+        return 'Invalid price'
+    if listing['nbr']!=-1 and listing['nbr']<=0:
+        return 'Invalid nbr'
+    return None
 
 @app.route('/examples')
 def examples():
-    # Setup classifier
-    ensemble = brf.BalRandomForest()
-    ensemble.load_model(clf_model)
+    legit_heads, scams_heads = get_examples(model_registry.current())
+    with stage_latency.time(('examples', 'render')):
+        return render_template('examples.html', 
+                               legit_tSample=legit_heads, scams_tSample=scams_heads)
+
+def get_examples(model):
+    """
+    Returns the example rows of the legit and scams test samples.
+    They are scored once and kept in memory; they are only
+    recomputed when the model or the test_sample files change.
+    """
+    key = [model.version] + [os.path.getmtime(fpath) for fpath in example_fpaths]
+    example_lock.acquire()
+    try:
+        if example_rows['key']!=key:
+            example_rows['rows'] = [_score_examples(model, fpath, modal_prefix)
+                                    for fpath, modal_prefix in 
+                                    zip(example_fpaths, ['ModalLegit', 'ModalScams'])]
+            example_rows['key'] = key
+        return example_rows['rows']
+    finally:
+        example_lock.release()
 
-    # legit test sample
-    legit_fpath  = './test_sample/hist_cl_legit_20130625-1650.json'
-    legit_json   = json.load(open(legit_fpath, 'r'))[:10]
-    legit_metric = metric.Metric(legit_json, coordMat, npriceList)
-    legit_farr   = legit_metric.format_metrics()
-    legit_score  = ensemble.predict(legit_farr)
-    legit_heads  = []
-    for p in range(len(legit_json)):
-        modal_label = 'ModalLegit' + str(p)
-        label, message = ff.get_sketchyLevel(legit_score[p])
-        hint_str = ff.get_hint(legit_farr[p])
-        legit_heads.append((legit_json[p]['head'],
-                            legit_json[p]['post'],
-                            label,
-                            message,
-                            hint_str,
-                            modal_label))
-    
-    # scams test sample
-    scams_fpath  = './test_sample/hist_cl_scams_20130625-1650.json'
-    scams_json   = json.load(open(scams_fpath, 'r'))[:10]
-    scams_metric = metric.Metric(scams_json, coordMat, npriceList)
-    scams_farr   = scams_metric.format_metrics()
-    scams_score  = ensemble.predict(scams_farr)
-    scams_heads  = []
-    for p in range(len(scams_json)):
-        modal_label = 'ModalScams' + str(p)
-        label, message = ff.get_sketchyLevel(scams_score[p])
-        hint_str = ff.get_hint(scams_farr[p])
-        scams_heads.append((scams_json[p]['head'],
-                            scams_json[p]['post'],
-                            label,
-                            message,
-                            hint_str,
-                            modal_label))
-
-
-    return render_template('examples.html', 
-                           legit_tSample=legit_heads, scams_tSample=scams_heads)
+def _score_examples(model, fpath, modal_prefix, n_examples=10):
+    """
+    Scores the first posts of a test sample
+
+    Output: list of (head, post, label, message, hint, modal label)
+    """
+    sample_json = list(itertools.islice(reviewTool.iter_listing_file(fpath), 
+                                        n_examples))
+    with stage_latency.time(('examples', 'features')):
+        sample_metric = metric.Metric(sample_json, model.coordMat, 
+                                      model.npriceList, model.coordTree)
+        sample_farr   = sample_metric.format_metrics()
+    with stage_latency.time(('examples', 'inference')):
+        sample_score  = model.ensemble.predict(sample_farr)
+    sample_heads  = []
+    for p in range(len(sample_json)):
+        modal_label = modal_prefix + str(p)
+        label, message = ff.get_sketchyLevel(sample_score[p])
+        hint_str = ff.get_hint(sample_farr[p])
+        sample_heads.append((sample_json[p]['head'],
+                             sample_json[p]['post'],
+                             label,
+                             message,
+                             hint_str,
+                             modal_label))
+    return sample_heads
 
 @app.route('/slides')
 def slides():
     return render_template('slides.html')
 
+# Score the examples with the model just loaded
+if all(os.path.exists(fpath) for fpath in example_fpaths):
+    get_examples(model_registry.current())
+
 if __name__ == '__main__':
     if socket.gethostbyname(socket.gethostname()).startswith('172'):
         address = '0.0.0.0'
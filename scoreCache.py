@@ -0,0 +1,81 @@
+#
+# scoreCache.py
+#
+# In-process cache of the scored listings (by pid) used by
+# the web app, with TTL expiry and an LRU bound on its size.
+#
+
+import time
+import threading
+from collections import OrderedDict
+
+class ScoreCache:
+    """
+    LRU cache of scored listings. The entries are tagged with the
+    version of the model that scored them: an entry is only returned
+    for that version, and the entries of the other versions are
+    dropped when a version is put for the first time (a request
+    still running on an older model does not empty the cache).
+    """
+
+    def __init__(self, max_size=10000, ttl=3600):
+        """
+        Input:  maximum number of listings, time to live (seconds)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._versions = set()     # model versions seen so far
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, pid, version=None):
+        """
+        Returns the cached entry of the pid (None if not cached,
+        expired or scored by another model version than the one given)
+        """
+        self._lock.acquire()
+        try:
+            item = self._entries.pop(pid, None)
+            if item is None or time.time()-item[0]>self.ttl or \
+               (version!=None and item[2]!=version):
+                self.misses += 1
+                return None
+            # most recently used go last
+            self._entries[pid] = item
+            self.hits += 1
+            return item[1]
+        finally:
+            self._lock.release()
+
+    def put(self, pid, entry, version=None):
+        """
+        Caches the entry of the pid (scored by the model version),
+        evicting the least recently used ones beyond max_size
+        """
+        self._lock.acquire()
+        try:
+            if version!=None and version not in self._versions:
+                # a new model was swapped in: the entries of the
+                # previous ones can only miss from now on
+                for key in [key for key, item in self._entries.iteritems()
+                            if item[2]!=version]:
+                    del self._entries[key]
+                self._versions.add(version)
+            self._entries.pop(pid, None)
+            self._entries[pid] = (time.time(), entry, version)
+            while len(self._entries)>self.max_size:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
@@ -0,0 +1,132 @@
+#
+# scoreTool.py
+#
+# Offline (re)scoring of whole archives of listing dumps.
+# The dumps are streamed in fixed-size chunks, the chunks are
+# scored by a pool of worker processes (each one memory maps
+# the same model file) and the pid/score/label rows are written
+# as soon as their chunk is scored, in the input order.
+#
+
+import sys
+import itertools
+import collections
+import multiprocessing as mp
+from optparse import OptionParser
+import metric
+import reviewTool
+import textStats
+import frontFormating as ff
+import bRandomForest as brf
+
+_worker_data = {}
+
+def score_files(model_fname, fname_list, out_fname, chunk_size=2000, n_jobs=1):
+    """
+    Scores the listings of the dumps and writes a csv file of
+    pid, score and label. Only a few chunks are in memory at a
+    time, whatever the size of the archive (so duplicated pids
+    are not dropped: each copy is scored).
+
+    Input:  model file (see BalRandomForest.export_model), list of
+            json or JSON Lines dumps, output file name, number of
+            listings per chunk, number of worker processes
+            (None for one per cpu)
+    Output: number of listings scored
+    """
+    if n_jobs==None:
+        n_jobs = mp.cpu_count()
+    chunks = iter_chunks(fname_list, chunk_size)
+    n_scored = 0
+    out = open(out_fname, 'w')
+    try:
+        out.write('pid,score,label\n')
+        for scored in _iter_scored_chunks(model_fname, chunks, n_jobs):
+            out.write(''.join('%d,%.6f,%s\n' % row for row in scored))
+            out.flush()
+            n_scored += len(scored)
+    finally:
+        out.close()
+    return n_scored
+
+def iter_chunks(fname_list, chunk_size=2000):
+    """
+    Yields the listings of the dumps in lists of chunk_size
+    """
+    listings = itertools.chain.from_iterable(
+        reviewTool.iter_listing_file(fname) for fname in fname_list)
+    while True:
+        chunk = list(itertools.islice(listings, chunk_size))
+        if len(chunk)==0:
+            break
+        yield chunk
+
+def _iter_scored_chunks(model_fname, chunks, n_jobs):
+    """
+    Scores the chunks in order. With several workers at most
+    2*n_jobs chunks are queued (Pool.imap would read all of
+    them ahead).
+    """
+    if n_jobs<=1:
+        _init_worker(model_fname)
+        for chunk in chunks:
+            yield _score_chunk(chunk)
+        return
+    pool = mp.Pool(n_jobs, initializer=_init_worker, initargs=(model_fname,))
+    try:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_score_chunk, (chunk,)))
+            if len(pending)>=2*n_jobs:
+                yield pending.popleft().get()
+        while len(pending)>0:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+
+def _init_worker(model_fname):
+    """
+    Loads the model in the worker process (the node arrays are
+    memory mapped, so the workers share their pages)
+    """
+    ensemble = brf.BalRandomForest()
+    coordMat, npriceList = ensemble.load_model_file(model_fname)
+    _worker_data['ensemble']   = ensemble
+    _worker_data['coordMat']   = coordMat
+    _worker_data['npriceList'] = npriceList
+    _worker_data['coordTree']  = metric.build_coord_tree(coordMat)
+
+def _score_chunk(chunk):
+    """
+    Scores a chunk of listings (the ones without post are skipped).
+    The phone numbers are reprocessed as in reviewTool.load_listings.
+
+    Output: list of (pid, score, label)
+    """
+    for post in chunk:
+        if post.get('hasPost')==1:
+            post['phone'] = textStats.get_phone_number(post['post'])
+    m = metric.Metric(chunk, _worker_data['coordMat'],
+                      _worker_data['npriceList'], _worker_data['coordTree'])
+    if len(m.listing)==0:
+        return []
+    post_score = _worker_data['ensemble'].predict(m.format_metrics())
+    return [(pid, score, ff.get_sketchyLevel(score)[1])
+            for pid, score in zip(m.listing.pid.tolist(), post_score.tolist())]
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="python scoreTool.py [options] model.lsm "
+                                "out.csv dump1.json [dump2.jsonl ...]")
+    parser.add_option('-c', '--chunk-size', type='int', default=2000,
+                      help="listings per chunk (default 2000)")
+    parser.add_option('-j', '--n-jobs', type='int', default=None,
+                      help="worker processes (default one per cpu)")
+    options, args = parser.parse_args()
+    if len(args)<3:
+        parser.print_usage()
+        sys.exit(1)
+    n_scored = score_files(args[0], args[2:], args[1],
+                           options.chunk_size, options.n_jobs)
+    print "<> %d listings scored, written to %s" % (n_scored, args[1])
@@ -5,11 +5,13 @@
 # and data formating for storing
 #
 
-import urllib2
 import re
 import json
 import time
-from bs4 import BeautifulSoup
+import itertools
+import fetchTool
+import pageParser
+import textStats
 
 class ScrapeTool:
     """
@@ -20,11 +22,12 @@ class ScrapeTool:
     posts are reviewed to check for scams.
     """
 
-    def __init__(self, n=1000):
+    def __init__(self, n=1000, cache=None):
         """
         Initialize with the number of posts to be scraped.
         The input is rounded to the nearest 100th. 
-        The default is 1000. 
+        The default is 1000. The post pages can be shared
+        through a fetchTool.PageCache.
         """
         n = n - (n%100)
         self.url_root = "http://sfbay.craigslist.org"
@@ -33,6 +36,7 @@ class ScrapeTool:
             lvl_string = 'index' + '%s' % str(i) + '.html'
             self.posting_lvl_list.append(lvl_string)
         self._listing_pristine = []
+        self.cache = cache
 
     def scrape(self):
         """
@@ -41,29 +45,83 @@ class ScrapeTool:
         for posting_lvl in self.posting_lvl_list:
             url = self.url_root + '/apa/' + posting_lvl
             print url
-            page = urllib2.urlopen(url)
-            soup = BeautifulSoup(page)
-            curr_listing = soup.find_all('p', attrs={'class':'row'})
+            page = fetchTool.fetch_page(url)
+            curr_listing = pageParser.parse_index(page)
             for listing in curr_listing:
                 # listing_info : [pid, head, lon, lat, prc, nbr]
                 listing_info = self._extract_listing_info(listing)
                 # listing_link
-                listing_link = self.url_root + str(listing.a['href'])
-                page = urllib2.urlopen(listing_link)
-                listing_soup = BeautifulSoup(page)
-                # Check for 'removed tag'
-                if len(listing_soup.find_all('div', attrs={'class':'removed'}))==0:
-                    listing_text = listing_soup.find_all('section', attrs={'id':'postingbody'})
-                    listing_text_clean = self._clean_text(listing_text)
-                    # extract phone number
-                    phone = self._extract_phone_number(listing_text_clean)
-                    listing_dict = self._store_listing(listing_info, listing_link, 
-                                                      phone, listing_text_clean)
+                listing_link = self.url_root + str(listing['href'])
+                page = fetchTool.fetch_page(listing_link, cache=self.cache)
+                listing_dict = self._parse_listing_page(listing_info, listing_link, page)
+                if listing_dict!=None:
                     self._listing_pristine.append(listing_dict)
-                else:
-                    continue
         print "Done scraping"
 
+    def crawl(self, out_fname=None, n_workers=8, rate=5., timeout=10):
+        """
+        Crawls Craig's list with concurrent fetches of the index and
+        post pages. Each listing is written to disk (JSON Lines, one 
+        dictionary per line) as soon as it is parsed, instead of being
+        kept in memory.
+
+        Input:  output file name (default timestamped .jsonl),
+                number of concurrent fetches, maximum number of 
+                requests per second, timeout of each fetch (seconds)
+        Output: number of listings written
+        """
+        if out_fname==None:
+            out_fname = 'hist_cl_posts' + self._get_time_stamp() + '.jsonl'
+        limiter = fetchTool.RateLimiter(rate)
+        index_urls = [self.url_root + '/apa/' + posting_lvl 
+                      for posting_lvl in self.posting_lvl_list]
+        index_pages = fetchTool.iter_pages(index_urls, n_workers, timeout,
+                                           skip_errors=True, limiter=limiter)
+        n_written = 0
+        out = open(out_fname, 'a')
+        try:
+            for url, page in itertools.izip(index_urls, index_pages):
+                print url
+                if page==None:
+                    print "  ----> Bad index page (skip it!)"
+                    continue
+                listing_info = []
+                listing_link = []
+                for listing in pageParser.parse_index(page):
+                    listing_info.append(self._extract_listing_info(listing))
+                    listing_link.append(self.url_root + str(listing['href']))
+                listing_pages = fetchTool.iter_pages(listing_link, n_workers, timeout,
+                                                     skip_errors=True, limiter=limiter,
+                                                     cache=self.cache)
+                for info, link, page in itertools.izip(listing_info, listing_link,
+                                                       listing_pages):
+                    if page==None:
+                        continue
+                    listing_dict = self._parse_listing_page(info, link, page)
+                    if listing_dict!=None:
+                        out.write(json.dumps(listing_dict) + '\n')
+                        out.flush()
+                        n_written += 1
+        finally:
+            out.close()
+        print "Done crawling"
+        return n_written
+
+    def _parse_listing_page(self, listing_info, listing_link, page):
+        """
+        Parses the post page of a listing and returns the listing
+        dictionary (None if the post was removed)
+        """
+        listing_page = pageParser.parse_post(page)
+        # Check for 'removed tag'
+        if listing_page['removed']!=None:
+            return None
+        listing_text_clean = self._clean_text(listing_page['body'])
+        # extract phone number
+        phone = self._extract_phone_number(listing_text_clean)
+        return self._store_listing(listing_info, listing_link, 
+                                   phone, listing_text_clean)
+
     def dump_scraped_listing(self):
         """
         Dumps the list of dictionaries into a json file.
@@ -96,47 +154,23 @@ class ScrapeTool:
 
     def _extract_listing_info(self, listing):
         """
-        Extracts info from the listing input (beautiful soup tag)
-        and returns a list of the following parameters:
+        Extracts info from the listing input (row of
+        pageParser.parse_index) and returns a list of the 
+        following parameters:
                 pid, head, lon, lat, prc, nbr
         (in this order).
         """
-        nbr_match = re.search(' / [0-9]br - ', str(listing))
-        prc_match = re.search('\$\d+', str(listing))
-        head = listing.find_all('a')[1].string
-        pid = int(listing.get('data-pid'))
-        # Check for presence of location
-        if listing.has_attr('data-longitude') and \
-           listing.has_attr('data-latitude'):
-            lon = float(listing.get('data-longitude'))
-            lat = float(listing.get('data-latitude'))
-        else:
-            lon = -1
-            lat = -1
-        # Check for presence of # of rooms
-        if nbr_match!=None:
-            nbr = int(re.sub('[ /a-z-]*', '', nbr_match.group()))
-        else:
-            nbr = -1
-        # Check for presence of price
-        if prc_match!=None:
-            #price_str = listing.find('span', attrs={'class':'price'}).string
-            #price = float(re.sub('\$', '', price_str))
-            price_str = prc_match.group()
-            price = float(re.sub('\$', '', str(prc_match.group())))
-        else:
-            price = -1
-        return [pid, head, lon, lat, price, nbr]
+        return [listing['pid'], listing['head'], listing['lon'],
+                listing['lat'], listing['price'], listing['nbr']]
 
     def _clean_text(self, listing_text):
         """
-        Given a list of body text (possibly one element list) this
+        Given the body text (None if the post has none) this
         method return the cleaned up body text or an empty string 
         if no text is found.
         """
-        if len(listing_text)>0:
-            listing_text_clean = ' '.join(listing_text[0].findAll(text=True))
-            listing_text_clean = re.sub('\n|\t', ' ', listing_text_clean)
+        if listing_text!=None:
+            listing_text_clean = re.sub('\n|\t', ' ', listing_text)
             listing_text_clean = re.sub('\s+', ' ', listing_text_clean)
             listing_text_clean = re.sub("'", '', listing_text_clean)
             listing_text_clean = re.sub('"', '', listing_text_clean)
@@ -152,11 +186,7 @@ class ScrapeTool:
         It returns a
         """
         if len(listing_text_clean.split())>0:
-            phone_match = re.findall('\d{3}\W*\d{3}\W*\d{4}', listing_text_clean)
-            if len(phone_match)>0:
-                phone = int(re.sub(r'\W', '', phone_match[0]))
-            else:
-                phone = -1
+            phone = textStats.get_phone_number(listing_text_clean)
         else:
             listing_text_clean = ' ' 
             phone = -1
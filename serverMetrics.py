@@ -0,0 +1,191 @@
+#
+# serverMetrics.py
+#
+# Low overhead counters, latency histograms and gauges for the
+# web app, rendered in the Prometheus text exposition format.
+#
+
+import time
+import threading
+
+# latency buckets (seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1., 2.5, 5., 10.)
+
+class Counter:
+    """
+    Monotonic counter, one value per combination of labels
+    """
+
+    def __init__(self, name, help_str, label_names=()):
+        self.name = name
+        self.help_str = help_str
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values=(), value=1):
+        self._lock.acquire()
+        try:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+        finally:
+            self._lock.release()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_str),
+                 '# TYPE %s counter' % self.name]
+        self._lock.acquire()
+        try:
+            for label_values in sorted(self._values):
+                lines.append('%s%s %s' % (self.name,
+                    _format_labels(self.label_names, label_values),
+                    _format_value(self._values[label_values])))
+        finally:
+            self._lock.release()
+        return lines
+
+class Histogram:
+    """
+    Histogram of observations (cumulative buckets, sum and count),
+    one per combination of labels
+    """
+
+    def __init__(self, name, help_str, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_str = help_str
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}       # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_values=()):
+        self._lock.acquire()
+        try:
+            hist = self._values.get(label_values)
+            if hist==None:
+                hist = [[0]*len(self.buckets), 0., 0]
+                self._values[label_values] = hist
+            for i in range(len(self.buckets)-1, -1, -1):
+                if value>self.buckets[i]:
+                    break
+                hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+        finally:
+            self._lock.release()
+
+    def time(self, label_values=()):
+        """
+        Returns a timer (context manager) observing the time
+        spent in its block
+        """
+        return Timer(self, label_values)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_str),
+                 '# TYPE %s histogram' % self.name]
+        label_names = self.label_names + ('le',)
+        self._lock.acquire()
+        try:
+            for label_values in sorted(self._values):
+                bucket_counts, total, count = self._values[label_values]
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append('%s_bucket%s %d' % (self.name,
+                        _format_labels(label_names, label_values + (_format_value(bound),)),
+                        bucket_count))
+                lines.append('%s_bucket%s %d' % (self.name,
+                    _format_labels(label_names, label_values + ('+Inf',)), count))
+                labels = _format_labels(self.label_names, label_values)
+                lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+                lines.append('%s_count%s %d' % (self.name, labels, count))
+        finally:
+            self._lock.release()
+        return lines
+
+class Gauge:
+    """
+    Value read from a function when the metrics are rendered
+    (of type counter if it only increases, e.g. cache hits)
+    """
+
+    def __init__(self, name, help_str, func, metric_type='gauge'):
+        self.name = name
+        self.help_str = help_str
+        self.func = func
+        self.metric_type = metric_type
+
+    def render(self):
+        return ['# HELP %s %s' % (self.name, self.help_str),
+                '# TYPE %s %s' % (self.name, self.metric_type),
+                '%s %s' % (self.name, _format_value(self.func()))]
+
+class Timer:
+    """
+    Context manager observing the elapsed time of its block
+    in a histogram
+    """
+
+    def __init__(self, histogram, label_values=()):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, self.label_values)
+        return False
+
+class Registry:
+    """
+    Set of metrics rendered together (the /metrics page)
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_str, label_names=()):
+        return self._add(Counter(name, help_str, label_names))
+
+    def histogram(self, name, help_str, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help_str, label_names, buckets))
+
+    def gauge(self, name, help_str, func, metric_type='gauge'):
+        return self._add(Gauge(name, help_str, func, metric_type))
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+def get_ratio(numerator, denominator):
+    """
+    Ratio of two counts (0 when there is nothing to count yet)
+    """
+    if denominator==0:
+        return 0.
+    return numerator/float(denominator)
+
+def _format_labels(label_names, label_values):
+    if len(label_names)==0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in zip(label_names, label_values))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
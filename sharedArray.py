@@ -0,0 +1,25 @@
+#
+# sharedArray.py
+#
+# Helpers to share numpy arrays with worker processes
+# without pickling them for every task.
+#
+
+import ctypes
+import numpy as np
+import multiprocessing.sharedctypes as sharedctypes
+
+def share_array(arr, dtype=float):
+    """
+    Copies the array into shared memory. The returned array can be
+    handed to a multiprocessing.Pool initializer: the forked workers
+    all see the same physical pages.
+
+    Input:  numpy array, dtype of the shared copy (default float)
+    Output: numpy array backed by shared memory
+    """
+    arr = np.asarray(arr, dtype=dtype)
+    raw = sharedctypes.RawArray(ctypes.c_char, max(arr.nbytes, 1))
+    shared_arr = np.frombuffer(raw, dtype=arr.dtype)[:arr.size].reshape(arr.shape)
+    shared_arr[...] = arr
+    return shared_arr
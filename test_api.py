@@ -0,0 +1,117 @@
+#
+# test_api.py
+#
+# Checks the validation of the listings posted to /api/score, with
+# a small model trained on test_sample/ (the web app is imported
+# with LESSSKETCHY_MODEL pointing to it).
+#
+#   python -m unittest test_api
+#
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import metric
+import reviewTool
+import bRandomForest
+
+REPO_DIR   = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_DIR = os.path.join(REPO_DIR, 'test_sample')
+
+VALID_LISTING = {'pid': 1, 'lat': 37.7749, 'lon': -122.4194, 'price': 2000,
+                 'nbr': 1, 'post': 'Sunny studio, call 415-555-1234'}
+
+def export_sample_model(fname, n_estimators=10):
+    """
+    Trains a small forest on the test sample and exports it
+    """
+    legit = reviewTool.load_listings(
+        [os.path.join(SAMPLE_DIR, 'hist_cl_legit_20130625-1650.json')])
+    scams = reviewTool.load_listings(
+        [os.path.join(SAMPLE_DIR, 'hist_cl_scams_20130625-1650.json')])
+    nprice, coordMat = reviewTool.get_nprice_and_coordMat(legit)
+    coordTree = metric.build_coord_tree(coordMat)
+    np.random.seed(0)
+    brf = bRandomForest.BalRandomForest(
+        metric.Metric(legit, coordMat, nprice, coordTree).format_metrics(),
+        metric.Metric(scams, coordMat, nprice, coordTree).format_metrics())
+    brf.train(n_estimators)
+    brf.export_model(fname, coordMat, nprice)
+
+
+class ApiScoreTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # the app writes its page cache in the working directory
+        cls.tmp_dir = tempfile.mkdtemp()
+        model_fname = os.path.join(cls.tmp_dir, 'sample.lsm')
+        export_sample_model(model_fname)
+        os.environ['LESSSKETCHY_MODEL'] = model_fname
+        cwd = os.getcwd()
+        sys.path.insert(0, REPO_DIR)
+        os.chdir(cls.tmp_dir)
+        try:
+            import run_flask
+        finally:
+            os.chdir(cwd)
+        cls.client = run_flask.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def score(self, listings):
+        response = self.client.post('/api/score', data=json.dumps({'listings': listings}),
+                                    content_type='application/json')
+        return response.status_code, json.loads(response.data)
+
+    def score_one(self, **fields):
+        listing = dict(VALID_LISTING)
+        listing.update(fields)
+        status, data = self.score([listing])
+        self.assertEqual(status, 200)
+        return data['results'][0]
+
+    def test_valid(self):
+        result = self.score_one()
+        self.assertTrue(0<=result['score']<=1)
+        self.assertEqual(result['features']['hasPhone'], 1)
+
+    def test_no_post(self):
+        self.assertEqual(self.score_one(post=' ')['error'], 'No post text')
+
+    def test_zero_nbr(self):
+        # price/nbr would be infinite
+        self.assertEqual(self.score_one(nbr=0)['error'], 'Invalid nbr')
+        self.assertEqual(self.score_one(nbr=-3)['error'], 'Invalid nbr')
+
+    def test_nan_location(self):
+        # json accepts NaN, the spatial index does not
+        self.assertEqual(self.score_one(lat=float('nan'))['error'], 'Invalid lat')
+        self.assertEqual(self.score_one(lon=float('inf'))['error'], 'Invalid lon')
+
+    def test_invalid_price(self):
+        self.assertEqual(self.score_one(price=float('-inf'))['error'], 'Invalid price')
+        self.assertEqual(self.score_one(price=1e308)['error'], 'Invalid price')
+
+    def test_mixed_batch(self):
+        # the invalid listings do not prevent scoring the other ones
+        status, data = self.score([dict(VALID_LISTING, nbr=0),
+                                   dict(VALID_LISTING, pid=2),
+                                   dict(VALID_LISTING, pid=3, lat=float('nan'))])
+        self.assertEqual(status, 200)
+        self.assertEqual([('error' in result, result['pid']) for result in data['results']],
+                         [(True, 1), (False, 2), (True, 3)])
+
+    def test_infinite_nbr(self):
+        status, data = self.score([dict(VALID_LISTING, nbr=float('inf'))])
+        self.assertEqual(status, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+#
+# test_metric.py
+#
+# Checks that Metric.format_metrics matches the original row by row
+# implementation (brute force cdist/argsort for the neighbourhood
+# median price), including the rows with equidistant neighbours.
+# Equidistant neighbours are now ordered by their coordMat index
+# (the original order was the one of an unstable quicksort), so
+# the reference sorts the distances with a stable sort.
+#
+#   python -m unittest test_metric
+#
+
+import os
+import re
+import unittest
+import numpy as np
+import pandas as pd
+import scipy.spatial as sp
+import metric
+import reviewTool
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_sample')
+
+def reference_format_metrics(listing, coordMat, npriceList):
+    """
+    The original format_metrics: one cdist and one argsort per row
+    (stable, the equidistant neighbours are in coordMat order)
+    """
+    listing = reviewTool.remove_noPosts(pd.DataFrame(listing))
+    lat   = list(listing.lat)
+    lon   = list(listing.lon)
+    phone = list(listing.phone)
+    nbr   = list(listing.nbr)
+    price = list(listing.price)
+    post  = list(listing.post)
+    feature_arr = np.zeros((len(listing), 7))
+    for i in range(len(listing)):
+        feature_arr[i, 0] = 1 if lat[i]!=-1 else 0
+        feature_arr[i, 1] = 1 if phone[i]!=-1 else 0
+        feature_arr[i, 2] = 1 if nbr[i]!=-1 else 0
+        feature_arr[i, 3] = 1 if price[i]!=-1 else 0
+        feature_arr[i, 4] = len(re.findall('[A-Z]', post[i]))/(len(post[i])*1.)
+        feature_arr[i, 5] = len(post[i].split())
+        if price[i]!=-1 and nbr[i]!=-1 and lat[i]!=-1 and lon[i]!=-1:
+            nprice = price[i]/(1.*nbr[i])
+            dist_arr = sp.distance.cdist([[lon[i], lat[i]]], coordMat)[0]
+            median_nprice = np.median(npriceList[np.argsort(dist_arr, kind='mergesort')[1:21]])
+            feature_arr[i, 6] = (nprice - median_nprice)/median_nprice
+    return feature_arr
+
+def count_tied_rows(feature_listing, coordMat):
+    """
+    Number of rows with a price info whose skipped closest neighbour
+    or 20th neighbour is tied with the next one
+    """
+    listing = reviewTool.remove_noPosts(pd.DataFrame(feature_listing))
+    wInfo = (listing.price!=-1) & (listing.nbr!=-1) & \
+            (listing.lat!=-1)   & (listing.lon!=-1)
+    loc_arr = np.column_stack((listing.lon[wInfo], listing.lat[wInfo]))
+    dist_arr = metric.build_coord_tree(coordMat).query(loc_arr, k=22)[0]
+    return np.sum((dist_arr[:, 0]==dist_arr[:, 1]) | (dist_arr[:, 20]==dist_arr[:, 21]))
+
+
+class FormatMetricsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.legit = reviewTool.load_listings(
+            [os.path.join(SAMPLE_DIR, 'hist_cl_legit_20130625-1650.json')])
+        cls.scams = reviewTool.load_listings(
+            [os.path.join(SAMPLE_DIR, 'hist_cl_scams_20130625-1650.json'),
+             os.path.join(SAMPLE_DIR, 'hist_cl_scams_20130629-2100.json')])
+        cls.npriceList, cls.coordMat = reviewTool.get_nprice_and_coordMat(cls.legit)
+
+    def check_listing(self, listing, coordMat, npriceList):
+        farr = metric.Metric(listing, coordMat, npriceList).format_metrics()
+        ref_farr = reference_format_metrics(listing, coordMat, npriceList)
+        self.assertEqual(farr.shape, ref_farr.shape)
+        self.assertTrue(np.array_equal(farr, ref_farr))
+
+    def test_test_sample_legit(self):
+        # the legit listings are in coordMat: many equidistant neighbours
+        self.assertGreater(count_tied_rows(self.legit, self.coordMat), 0)
+        self.check_listing(self.legit, self.coordMat, self.npriceList)
+
+    def test_test_sample_scams(self):
+        self.check_listing(self.scams, self.coordMat, self.npriceList)
+
+    def test_grid_ties(self):
+        # every point of a grid has rings of equidistant neighbours
+        # with different prices, straddling the 1st and 20th ones
+        rng = np.random.RandomState(0)
+        lon, lat = np.meshgrid(np.arange(-122.5, -122.3, 0.01),
+                               np.arange(37.7, 37.9, 0.01))
+        coordMat = np.column_stack((lon.ravel(), lat.ravel()))
+        coordMat = np.concatenate((coordMat, coordMat[:50]))    # duplicated points
+        npriceList = rng.randint(500, 3000, size=len(coordMat))/1.
+        listing = [{'hasPost': 1, 'lon': coordMat[i, 0], 'lat': coordMat[i, 1],
+                    'price': 2000., 'nbr': 2, 'phone': -1, 'post': u'Nice Place'}
+                   for i in rng.permutation(len(coordMat))[:120]]
+        self.assertGreater(count_tied_rows(listing, coordMat), 0)
+        self.check_listing(listing, coordMat, npriceList)
+
+    def test_tie_beyond_neighbours(self):
+        # 60 listings at the same place: the tie goes beyond the first
+        # queried neighbours, which are not the ones of lowest index
+        loc = [-122.4, 37.7]
+        coordMat = np.concatenate((np.tile([loc], (60, 1)),
+            np.column_stack((np.linspace(-122.3, -122.2, 10),
+                             np.linspace(37.8, 37.9, 10)))))
+        queried_idx = metric.build_coord_tree(coordMat).query([loc], k=32)[1][0]
+        self.assertFalse(np.array_equal(np.sort(queried_idx), np.arange(32)))
+        npriceList = np.full(len(coordMat), 3000.)
+        npriceList[:60] = np.arange(1000., 1600., 10.)
+        listing = [{'hasPost': 1, 'lon': loc[0], 'lat': loc[1], 'price': 2000.,
+                    'nbr': 1, 'phone': -1, 'post': u'Nice Place'}]
+        self.check_listing(listing, coordMat, npriceList)
+
+    def test_small_coordMat(self):
+        # fewer locations than queried neighbours
+        self.check_listing(self.scams.head(50), self.coordMat[:15], self.npriceList[:15])
+
+
+if __name__ == '__main__':
+    unittest.main()
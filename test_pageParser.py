@@ -0,0 +1,147 @@
+#
+# test_pageParser.py
+#
+# Checks that pageParser extracts the same fields as the former
+# BeautifulSoup code of query.py, scrapeTool.py and reviewTool.py,
+# on the craigslist pages of test_sample/pages/.
+#
+#   python -m unittest test_pageParser
+#
+
+import os
+import re
+import unittest
+from bs4 import BeautifulSoup
+import pageParser
+import reviewTool
+
+PAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'test_sample', 'pages')
+
+def read_page(fname):
+    return open(os.path.join(PAGE_DIR, fname), 'r').read()
+
+def soup_parse_index(page):
+    """
+    The former BeautifulSoup extraction of the index rows
+    (the regular expressions run on the markup of the row)
+    """
+    rows = []
+    for post in BeautifulSoup(page, 'html.parser').find_all('p', attrs={'class': 'row'}):
+        row = {}
+        row['pid'] = int(post.get('data-pid'))
+        if post.has_attr('data-longitude') and post.has_attr('data-latitude'):
+            row['lon'] = float(post.get('data-longitude'))
+            row['lat'] = float(post.get('data-latitude'))
+        else:
+            row['lon'] = -1
+            row['lat'] = -1
+        anchors = post.find_all('a')
+        row['href'] = anchors[0]['href'] if len(anchors)>0 else None
+        row['head'] = anchors[1].string if len(anchors)>1 else None
+        nbr_match = re.search(' / [0-9]br - ', str(post))
+        row['nbr'] = int(re.sub('[ /a-z-]*', '', nbr_match.group())) if nbr_match else -1
+        prc_match = re.search('\$\d+', str(post))
+        row['price'] = float(prc_match.group()[1:]) if prc_match else -1
+        rows.append(row)
+    return rows
+
+def soup_parse_post(page):
+    """
+    The former BeautifulSoup extraction of the posting body and
+    of the removal notice
+    """
+    soup = BeautifulSoup(page, 'html.parser')
+    body = soup.find_all('section', attrs={'id': 'postingbody'})
+    removed = soup.find_all('div', attrs={'class': 'removed'})
+    return {'body': ' '.join(body[0].findAll(text=True)) if len(body)>0 else None,
+            'removed': removed[0].get_text() if len(removed)>0 else None}
+
+def soup_review_verdict(page):
+    """
+    The former reviewTool._get_review_verdict (on the markup)
+    """
+    removed = BeautifulSoup(page, 'html.parser').find_all('div', attrs={'class': 'removed'})
+    if len(removed)>0 and re.search('flagged for removal', str(removed[0])):
+        return 'scams'
+    return 'legit'
+
+
+class ParseIndexTest(unittest.TestCase):
+
+    def test_index(self):
+        # entities, rows without coordinates, nested and unclosed tags,
+        # script and style content, a comment and a single anchor
+        page = read_page('index.html')
+        rows = pageParser.parse_index(page)
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows, soup_parse_index(page))
+        self.assertEqual(rows[1]['head'], u'Caf\xe9 & bakery below \u2013 studio')
+        self.assertEqual(rows[1]['price'], 1500)
+        self.assertEqual(rows[2]['head'], None)
+        self.assertEqual(rows[3]['lat'], -1)
+        self.assertEqual((rows[5]['head'], rows[5]['href']), (None, '/sfc/apa/3891104506.html'))
+
+    def test_index_split_markup(self):
+        # Documented difference: the price and number of bedrooms are
+        # now matched on the text of the row, not on its markup, so
+        # they are found even when split by tags ($<b>1200</b>, <b>2br</b>)
+        page = read_page('index_split.html')
+        row = pageParser.parse_index(page)[0]
+        soup_row = soup_parse_index(page)[0]
+        self.assertEqual((soup_row['price'], soup_row['nbr']), (-1, -1))
+        self.assertEqual((row['price'], row['nbr']), (1200, 2))
+        for name in ('pid', 'lon', 'lat', 'href', 'head'):
+            self.assertEqual(row[name], soup_row[name])
+
+    def test_empty_page(self):
+        self.assertEqual(pageParser.parse_index(''), [])
+
+
+class ParsePostTest(unittest.TestCase):
+
+    def check_page(self, fname):
+        page = read_page(fname)
+        post = pageParser.parse_post(page)
+        self.assertEqual(post, soup_parse_post(page))
+        self.assertEqual(reviewTool._get_review_verdict(page), soup_review_verdict(page))
+        return post
+
+    def test_post(self):
+        # entities (named, numeric, cp1252, unknown), nested sections,
+        # comments, and a script and a style mentioning postingbody
+        post = self.check_page('post.html')
+        self.assertTrue(u'Beautiful & sunny 2BR apartment \u2013 close to BART.' in post['body'])
+        self.assertTrue(u'It\'s "quiet" \u2013 no pets &bogus please.' in post['body'])
+        self.assertTrue(u'Nested section text' in post['body'])
+        self.assertTrue(u'After the nested section.' in post['body'])
+        self.assertFalse(u'not the body' in post['body'])
+        self.assertFalse(u'ignored' in post['body'])
+        self.assertEqual(post['removed'], None)
+
+    def test_post_unclosed(self):
+        post = self.check_page('post_unclosed.html')
+        self.assertTrue(u'a div' in post['body'])
+
+    def test_post_removed(self):
+        post = self.check_page('post_removed.html')
+        self.assertTrue(post['removed'].startswith(u'This posting has been flagged for removal.'))
+        self.assertEqual(reviewTool._get_review_verdict(read_page('post_removed.html')), 'scams')
+
+    def test_post_deleted(self):
+        post = self.check_page('post_deleted.html')
+        self.assertEqual(post['body'], None)
+        self.assertEqual(reviewTool._get_review_verdict(read_page('post_deleted.html')), 'legit')
+
+    def test_post_removed_split_markup(self):
+        # Documented difference: the removal notice is matched on its
+        # text, so a notice split by tags (<a>flagged</a> for removal)
+        # is now a scam (the markup based match missed it)
+        page = read_page('post_removed_split.html')
+        self.assertEqual(pageParser.parse_post(page), soup_parse_post(page))
+        self.assertEqual(soup_review_verdict(page), 'legit')
+        self.assertEqual(reviewTool._get_review_verdict(page), 'scams')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+#
+# test_query.py
+#
+# Checks Query.scrape and fetchTool against a local HTTP server
+# serving the pages of test_sample/pages/: concurrent fetches,
+# errors and keep-alive connections, and the size limit of the
+# page cache shared by several processes.
+#
+#   python -m unittest test_query
+#
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+import fetchTool
+import query
+
+PAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'test_sample', 'pages')
+
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the index page for /search/apa, a 404 for /missing.html
+    and a post page naming its path for the other .html pages
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def do_GET(self):
+        self.server.count('requests')
+        if self.path.startswith('/search/apa'):
+            self.send_page(200, open(os.path.join(PAGE_DIR, 'index.html')).read())
+        elif self.path.startswith('/search/broken'):
+            self.send_page(200, '<p class="row" data-pid="1"><a href="/missing.html"></a></p>')
+        elif self.path=='/missing.html':
+            self.send_page(404, 'Not Found')
+        elif self.path.endswith('.html'):
+            self.send_page(200, '<section id="postingbody">Call 415-555-1234 about %s'
+                                '</section>' % self.path)
+        else:
+            self.send_page(404, 'Not Found')
+
+    def send_page(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FixtureHandler)
+        self.counts = {'connections': 0, 'requests': 0}
+        self.handler_threads = []
+        self._lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        # one thread per connection, as ThreadingMixIn, kept to be joined
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        thread.start()
+        self.handler_threads.append((request, thread))
+
+    def close_connections(self):
+        """
+        Closes the keep-alive connections still open and waits
+        for their handler threads
+        """
+        for request, thread in self.handler_threads:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join()
+
+    def count(self, name):
+        self._lock.acquire()
+        try:
+            self.counts[name] += 1
+        finally:
+            self._lock.release()
+
+
+class ScrapeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FixtureServer()
+        cls.url_root = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.close_connections()
+        cls.server.server_close()
+
+    def setUp(self):
+        # no keep-alive connection left by another test
+        fetchTool.close_connections()
+
+    def get_query(self, search='apa'):
+        q = query.Query(['sunny', 'studio'])
+        q.url_root = self.url_root
+        q.url = self.url_root + '/search/%s?query=' % search
+        return q
+
+    def test_concurrent_scrape(self):
+        posts = self.get_query().scrape(5, n_workers=1)
+        self.assertEqual(len(posts), 5)
+        self.assertEqual(self.get_query().scrape(5, n_workers=4), posts)
+        self.assertEqual([post['pid'] for post in posts],
+                         [3891104501, 3891104502, 3891104503, 3891104504, 3891104505])
+        for post in posts:
+            self.assertTrue(post['link'].endswith('/%d.html' % post['pid']))
+            self.assertEqual(post['post'], 'Call 415-555-1234 about %s'
+                                           % post['link'][len(self.url_root):])
+            self.assertEqual(post['phone'], 4155551234)
+
+    def test_post_error(self):
+        for n_workers in (1, 4):
+            self.assertRaises(fetchTool.FetchError,
+                              self.get_query('broken').scrape, 5, n_workers)
+
+    def test_keep_alive(self):
+        connections = self.server.counts['connections']
+        requests = self.server.counts['requests']
+        self.get_query().scrape(5, n_workers=1)
+        self.assertEqual(self.server.counts['requests'] - requests, 6)
+        self.assertEqual(self.server.counts['connections'] - connections, 1)
+
+    def test_keep_alive_workers(self):
+        # the connections outlive the thread pool of each scrape
+        connections = self.server.counts['connections']
+        requests = self.server.counts['requests']
+        self.get_query().scrape(5, n_workers=4)
+        first_connections = self.server.counts['connections'] - connections
+        self.assertTrue(1<=first_connections<=4)
+        for n in range(2):
+            self.get_query().scrape(5, n_workers=4)
+        self.assertEqual(self.server.counts['requests'] - requests, 18)
+        self.assertEqual(self.server.counts['connections'] - connections, first_connections)
+
+    def test_fetch_error(self):
+        self.assertRaises(fetchTool.FetchError, fetchTool.fetch_page,
+                          self.url_root + '/missing.html')
+        # the connection is still usable after an error status
+        self.assertTrue('about /a.html' in fetchTool.fetch_page(self.url_root + '/a.html'))
+
+
+class PageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def get_size(self):
+        return sum(os.path.getsize(os.path.join(dirpath, fname))
+                   for dirpath, dirnames, fnames in os.walk(self.path)
+                   for fname in fnames if fname.endswith('.page'))
+
+    def test_shared_max_bytes(self):
+        # two processes writing in the same cache: each one sees the
+        # pages of the other when it checks the size on disk
+        caches = [fetchTool.PageCache(self.path, max_bytes=10000, check_interval=0)
+                  for n in range(2)]
+        for n in range(40):
+            caches[n % 2].put('http://host/%d.html' % n, 'x'*1000, {})
+            self.assertTrue(self.get_size()<=10000)
+        self.assertEqual(caches[0].get('http://host/39.html')[0], 'x'*1000)
+        self.assertEqual(caches[0].get('http://host/0.html'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#
+# textStats.py
+#
+# Batch statistics of the post texts (fraction of capital
+# letters, number of words and phone number) shared by the
+# training and the serving code.
+#
+
+import re
+import string
+import numpy as np
+
+_phone_re   = re.compile(r'\d{3}\W*\d{3}\W*\d{4}')
+_nonword_re = re.compile(r'\W')
+
+def get_text_stats(posts, with_phone=True):
+    """
+    Computes the text statistics of the posts
+
+    Input:  list (or pd series) of post texts, whether to look
+            for the phone numbers
+    Output: cap fraction (float array), number of words (int array),
+            phone numbers (int array, -1 if none; None if not asked)
+    """
+    n = len(posts)
+    cap_frac = np.empty(n, dtype=float)
+    n_words  = np.empty(n, dtype=np.int64)
+    for i, post in enumerate(posts):
+        cap_frac[i], n_words[i] = _get_post_stats(post)
+    phone = get_phone_numbers(posts) if with_phone else None
+    return cap_frac, n_words, phone
+
+def get_cap_fraction(posts):
+    """
+    Returns the fraction of capital letters (A-Z) of each post
+    """
+    return get_text_stats(posts, with_phone=False)[0]
+
+def get_n_words(posts):
+    """
+    Returns the number of words of each post
+    """
+    return get_text_stats(posts, with_phone=False)[1]
+
+def get_phone_numbers(posts):
+    """
+    Returns the first phone number of each post (-1 if none)
+    """
+    return np.fromiter((get_phone_number(post) for post in posts),
+                       dtype=np.int64, count=len(posts))
+
+def get_phone_number(text):
+    """
+    Returns the first phone number of the text (-1 if none)
+    """
+    phone_match = _phone_re.search(text)
+    if phone_match:
+        return int(_nonword_re.sub('', phone_match.group()))
+    return -1
+
+def _get_post_stats(post):
+    """
+    Returns the fraction of capital letters and the number
+    of words of a post
+    """
+    return _count_caps(post) / (len(post) * 1.), len(post.split())
+
+def _count_caps(text):
+    """
+    Number of A-Z letters. Counting the bytes deleted by
+    str.translate is much faster than a regex.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return len(text) - len(text.translate(None, string.ascii_uppercase))
@@ -12,41 +12,44 @@ import json
 import numpy as np
 import bRandomForest
 import reviewTool
+import listingStore
 import metric
 
 #def main():
 ### Data Prep ###
-list_files = os.listdir('./')
-list_files.sort()
-# This assumes that half of the files are legit and half 
-# are the corresponding scams
-mid_idx = len(list_files)/2
-legit = reviewTool.patch_listings(list_files[:mid_idx])
-scams = reviewTool.patch_listings(list_files[mid_idx:])
-# remove duplicates
-legit_clean = reviewTool.remove_duplicates([legit])
-scams_clean = reviewTool.remove_duplicates([scams])
-# remove noPosts
-legit_clean = reviewTool.remove_noPosts(legit_clean)
-scams_clean = reviewTool.remove_noPosts(scams_clean)
-# reprocess phone numbers (just in case)
-legit_clean = reviewTool.reprocess_phoneNumber_flag(legit_clean)
-scams_clean = reviewTool.reprocess_phoneNumber_flag(scams_clean)
+if os.path.isdir('./store_legit') and os.path.isdir('./store_scams'):
+    # read only the columns needed for the features
+    # from the listing stores (see listingStore.py)
+    columns = ['hasPost', 'lat', 'lon', 'price', 'nbr', 'phone', 'post']
+    legit_clean = listingStore.ListingStore('./store_legit').read(columns)
+    scams_clean = listingStore.ListingStore('./store_scams').read(columns)
+else:
+    list_files = os.listdir('./')
+    list_files.sort()
+    # This assumes that half of the files are legit and half 
+    # are the corresponding scams
+    mid_idx = len(list_files)/2
+    # stream the dumps: remove duplicates and noPosts, and
+    # reprocess phone numbers (just in case) in one pass
+    legit_clean = reviewTool.load_listings(list_files[:mid_idx])
+    scams_clean = reviewTool.load_listings(list_files[mid_idx:])
 print "<> Clean-up process done!"
 # get the normalized price and coordinate matrix
 nprice, coordMat = reviewTool.get_nprice_and_coordMat(legit_clean)
+coordTree = metric.build_coord_tree(coordMat)
 print "<> Got normalized prices and coordinates"
 # Get the training metrics
-legit_metric = metric.Metric(legit_clean, coordMat, nprice)
+legit_metric = metric.Metric(legit_clean, coordMat, nprice, coordTree)
 legit_farr   = legit_metric.format_metrics()
-scams_metric = metric.Metric(scams_clean, coordMat, nprice)
+scams_metric = metric.Metric(scams_clean, coordMat, nprice, coordTree)
 scams_farr   = scams_metric.format_metrics()
 print "<> Got the metrics"
 ### Data Training ###
 brf = bRandomForest.BalRandomForest(legit_farr, scams_farr)
 brf.allocate_test_sample()
-brf.train(1000)
+brf.train(1000, n_jobs=None)
 brf.pickle_trained_model('../pickle_jar/ensembleModel_scan12_v1.pickle')
+brf.export_model('../pickle_jar/ensembleModel_scan12_v1.lsm', coordMat, nprice)
 # Get some validations
 conf_mat = brf.get_confusion_matrix(brf.test_sample[:, :-1],
                                     brf.test_sample[:, -1],
@@ -1,78 +1,64 @@
 #!/usr/bin/python 
 
 #
-# splits the sample into 4 sets 
-# for crossvalidation
+# k-fold cross-validation of the model (see crossVal.py)
+#
+#   python trainModel_crossVal.py [-k 4] [-n 1000] [-j n_jobs]
 #
 
 import os
 import re
 import json
+import time
+from optparse import OptionParser
 import numpy as np
-import bRandomForest
 import reviewTool
+import listingStore
 import metric
+import crossVal
+
+parser = OptionParser(usage="python trainModel_crossVal.py [options]")
+parser.add_option('-k', '--n-folds', type='int', default=4,
+                  help="number of folds (default 4)")
+parser.add_option('-n', '--n-estimators', type='int', default=1000,
+                  help="trees per forest (default 1000)")
+parser.add_option('-j', '--n-jobs', type='int', default=None,
+                  help="worker processes (default one per cpu)")
+options, args = parser.parse_args()
 
 #def main():
 ### Data Prep ###
-list_files = os.listdir('./')
-list_files.sort()
-# This assumes that half of the files are legit and half 
-# are the corresponding scams
-mid_idx = len(list_files)/2
-legit = reviewTool.patch_listings(list_files[:mid_idx])
-scams = reviewTool.patch_listings(list_files[mid_idx:])
-# remove duplicates
-legit_clean = reviewTool.remove_duplicates([legit])
-scams_clean = reviewTool.remove_duplicates([scams])
-# remove noPosts
-legit_clean = reviewTool.remove_noPosts(legit_clean)
-scams_clean = reviewTool.remove_noPosts(scams_clean)
-# reprocess phone numbers (just in case)
-legit_clean = reviewTool.reprocess_phoneNumber_flag(legit_clean)
-scams_clean = reviewTool.reprocess_phoneNumber_flag(scams_clean)
+if os.path.isdir('./store_legit') and os.path.isdir('./store_scams'):
+    # read only the columns needed for the features
+    # from the listing stores (see listingStore.py)
+    columns = ['hasPost', 'lat', 'lon', 'price', 'nbr', 'phone', 'post']
+    legit_clean = listingStore.ListingStore('./store_legit').read(columns)
+    scams_clean = listingStore.ListingStore('./store_scams').read(columns)
+else:
+    list_files = os.listdir('./')
+    list_files.sort()
+    # This assumes that half of the files are legit and half 
+    # are the corresponding scams
+    mid_idx = len(list_files)/2
+    # stream the dumps: remove duplicates and noPosts, and
+    # reprocess phone numbers (just in case) in one pass
+    legit_clean = reviewTool.load_listings(list_files[:mid_idx])
+    scams_clean = reviewTool.load_listings(list_files[mid_idx:])
 print "<> Clean-up process done!"
 
-# creates 4 independent sample sets
-n_legit = len(legit_clean)
-n_scams = len(scams_clean)
-legit_clean_arr = []
-scams_clean_arr = []
-for i in range(4):
-    if i<3:
-        legit_clean_arr.append(legit_clean[i*(n_legit/4):(i+1)*(n_legit/4)])
-        scams_clean_arr.append(scams_clean[i*(n_scams/4):(i+1)*(n_scams/4)])
-    else:
-        legit_clean_arr.append(legit_clean[i*(n_legit/4):])
-        scams_clean_arr.append(scams_clean[i*(n_scams/4):])
-
-prf_arr    = []
-fscore_arr = []
-for i in range(4):
-    print i, '...',
-    legit_clean = legit_clean_arr[i]
-    scams_clean = scams_clean_arr[i]
-    # get the normalized price and coordinate matrix
-    nprice, coordMat = reviewTool.get_nprice_and_coordMat(legit_clean)
-    #print "<> Got normalized prices and coordinates"
-    # Get the training metrics
-    legit_metric = metric.Metric(legit_clean, coordMat, nprice)
-    legit_farr   = legit_metric.format_metrics()
-    scams_metric = metric.Metric(scams_clean, coordMat, nprice)
-    scams_farr   = scams_metric.format_metrics()
-    #print "<> Got the metrics"
-    ### Data Training ###
-    brf = bRandomForest.BalRandomForest(legit_farr, scams_farr)
-    brf.allocate_test_sample()
-    brf.train(1000)
-    #brf.pickle_trained_model('../pickle_jar/ensembleModel_scan12_v1.pickle')
-    # Get some validations
-    conf_mat = brf.get_confusion_matrix(brf.test_sample[:, :-1],
-                                        brf.test_sample[:, -1],
-                                        0.5)
-    prf = brf.get_precision_recall(conf_mat)
-    fscore = (2.*(prf[0]*prf[1])/(prf[0]+prf[1]))
-    prf_arr.append(prf)
-    fscore_arr.append(fscore)
-    print 'done'
+# the features are computed once, with the prices and coordinates
+# of all the legit listings (as in trainModel.py), and shared by
+# all the folds
+start = time.time()
+nprice, coordMat = reviewTool.get_nprice_and_coordMat(legit_clean)
+coordTree = metric.build_coord_tree(coordMat)
+legit_farr = metric.Metric(legit_clean, coordMat, nprice, coordTree).format_metrics()
+scams_farr = metric.Metric(scams_clean, coordMat, nprice, coordTree).format_metrics()
+print "<> Got the metrics in %.1f s" % (time.time() - start)
 
+### Cross-validation ###
+start = time.time()
+results = crossVal.cross_validate(legit_farr, scams_farr, options.n_folds,
+                                  options.n_estimators, options.n_jobs)
+print "<> %d folds done in %.1f s" % (options.n_folds, time.time() - start)
+crossVal.print_report(results)